@@ -0,0 +1,111 @@
+"""
+.. module: historical_reports.s3.checkpoint
+    :platform: Unix
+    :copyright: (c) 2017 by Netflix Inc., see AUTHORS for more
+    :license: Apache, see LICENSE for more details.
+.. author:: Mike Grima <mgrima@netflix.com>
+
+Helpers for the checkpointed (resumable) full report. When `CONFIG.checkpoint` is set, the progress of the scan is
+saved to a staging prefix in the first dump bucket as it goes:
+```
+historical-s3-report-staging/state.json
+historical-s3-report-staging/parts/00000.json
+...
+```
+Each part holds the serialized bucket entries that were scanned since the previous checkpoint, and the state holds the
+key of the last item that was checkpointed for each scan segment. If an invocation runs out of time, then the next
+invocation resumes the scan from there. Once the scan is complete, the parts are merged into the report and the
+staging objects are deleted. (This is not used for the sharded report layout.)
+"""
+import logging
+
+from historical.constants import LOGGING_LEVEL
+
+from historical_reports.s3.config import CONFIG
+from historical_reports.s3.json_backend import dumps, loads
+from historical_reports.s3.models import get_generated_time
+from historical_reports.s3.util import delete_objects, get_bucket_client, _get_from_s3, _upload_to_s3
+
+logging.basicConfig()
+log = logging.getLogger('historical-reports-s3')
+log.setLevel(LOGGING_LEVEL)
+
+
+def get_staging_bucket():
+    return CONFIG.dump_to_buckets[0]
+
+
+def get_staging_key(name, staging_prefix=None):
+    return f"{staging_prefix or CONFIG.staging_prefix}/{name}"
+
+
+def new_state(total_segments, staging_prefix=None):
+    return {
+        "generated_date": get_generated_time(),
+        "staging_prefix": staging_prefix or CONFIG.staging_prefix,
+        "segments": {str(segment): {"last_key": None, "complete": False} for segment in range(total_segments)},
+        "parts": []
+    }
+
+
+def load_state(staging_prefix=None):
+    """Fetches the state of the checkpointed report from the staging prefix. Returns None if there isn't one."""
+    bucket = get_staging_bucket()
+    state, _ = _get_from_s3(get_bucket_client(bucket), bucket, get_staging_key("state.json", staging_prefix))
+    if not state:
+        return None
+
+    return loads(state)
+
+
+def save_state(state):
+    bucket = get_staging_bucket()
+    _upload_to_s3(dumps(state, compact=True).encode("utf-8"), get_bucket_client(bucket), bucket,
+                  get_staging_key("state.json", state["staging_prefix"]))
+
+
+def save_checkpoint(state, segment, entries, last_key, complete=False):
+    """
+    Saves the entries that were scanned since the previous checkpoint as a new part, followed by the state.
+    The part is always saved before the state, so the state never refers to a part that wasn't saved.
+    :param segment: The scan segment that the entries came from.
+    :param entries: The dict of the serialized bucket entries.
+    :param last_key: The key of the last item that was scanned -- the scan of the segment resumes after it.
+    :param complete: Whether the scan of the segment is complete.
+    """
+    bucket = get_staging_bucket()
+    if entries:
+        key = get_staging_key(f"parts/{len(state['parts']):05d}.json", state["staging_prefix"])
+        _upload_to_s3(dumps(entries, compact=True).encode("utf-8"), get_bucket_client(bucket), bucket, key)
+        state["parts"].append(key)
+
+    state["segments"][str(segment)] = {"last_key": last_key, "complete": complete}
+    save_state(state)
+
+    log.debug(f"[+] Checkpointed segment {segment} with {len(entries)} buckets. Complete: {complete}.")
+
+
+def iterate_parts(state):
+    """Yields the serialized bucket entries (name, details) from all of the saved parts, in order."""
+    bucket = get_staging_bucket()
+    client = get_bucket_client(bucket)
+    for key in state["parts"]:
+        part, _ = _get_from_s3(client, bucket, key)
+        yield from loads(part).items()
+
+
+def list_staged(prefix):
+    """Lists the keys of all of the staged objects under the prefix."""
+    bucket = get_staging_bucket()
+    paginator = get_bucket_client(bucket).get_paginator("list_objects_v2")
+
+    return [obj["Key"] for page in paginator.paginate(Bucket=bucket, Prefix=prefix) for obj in page.get("Contents", [])]
+
+
+def delete_staged(keys):
+    delete_objects(get_staging_bucket(), keys)
+
+
+def delete_staging(state):
+    """Deletes all of the staged parts and the state."""
+    delete_staged(state["parts"] + [get_staging_key("state.json", state["staging_prefix"])])
@@ -12,6 +12,8 @@ import click
 from historical.constants import LOGGING_LEVEL
 
 from historical_reports.s3.config import CONFIG
+from historical_reports.s3.deltas import compact_deltas
+from historical_reports.s3.export import build_report_from_export
 from historical_reports.s3.generate import dump_report
 
 logging.basicConfig()
@@ -37,6 +39,22 @@ def get_dump_prefix(ctx, param, prefix):
     CONFIG.dump_to_prefix = prefix
 
 
+def get_scan_segments(ctx, param, segments):
+    CONFIG.scan_segments = segments
+
+
+def get_scan_rate_limit(ctx, param, rate_limit):
+    CONFIG.scan_rate_limit = rate_limit
+
+
+def get_delta_retention(ctx, param, retention):
+    CONFIG.delta_retention = retention
+
+
+def get_shard_by(ctx, param, fields):
+    CONFIG.shard_by = [field for field in fields.split(",") if field]
+
+
 @cli.command()
 @click.option("--bucket", type=click.STRING, required=True, help="Comma separated list of S3 bucket to dump the "
                                                                  "report to.", callback=get_bucket)
@@ -45,8 +63,51 @@ def get_dump_prefix(ctx, param, prefix):
               callback=get_exclude_fields)
 @click.option("--dump-prefix", type=click.STRING, required=False, default="historical-s3-report.json",
               callback=get_dump_prefix)
+@click.option("--scan-segments", type=click.IntRange(min=1), required=False, default=1,
+              help="Number of DynamoDB scan segments to scan in parallel.", callback=get_scan_segments)
+@click.option("--scan-rate-limit", type=click.FLOAT, required=False, default=0,
+              help="Read capacity units per second to limit the scan to (0 for no limit).",
+              callback=get_scan_rate_limit)
+@click.option("--shard-by", type=click.STRING, required=False, default="",
+              help="Comma separated report fields (AccountId,Region) to split the report into shards by.",
+              callback=get_shard_by)
 @click.option("-c", "--commit", default=False, is_flag=True, help="Will only dump to S3 if commit flag is present")
-def generate(bucket, exclude_fields, dump_prefix, commit):
+def generate(bucket, exclude_fields, dump_prefix, scan_segments, scan_rate_limit, shard_by, commit):
     if not commit:
         log.warning("[@] COMMIT FLAG NOT SET -- NOT SAVING ANYTHING TO S3!")
     dump_report(commit=commit)
+
+
+@cli.command("generate-from-export")
+@click.argument("source", type=click.STRING)
+@click.option("--bucket", type=click.STRING, required=True, help="Comma separated list of S3 bucket to dump the "
+                                                                 "report to.", callback=get_bucket)
+@click.option("--exclude-fields", type=click.STRING, required=False, default="Name,_version",
+              help="Comma separated top-level fields to not be included in the final report.",
+              callback=get_exclude_fields)
+@click.option("--dump-prefix", type=click.STRING, required=False, default="historical-s3-report.json",
+              callback=get_dump_prefix)
+@click.option("--shard-by", type=click.STRING, required=False, default="",
+              help="Comma separated report fields (AccountId,Region) to split the report into shards by.",
+              callback=get_shard_by)
+@click.option("-c", "--commit", default=False, is_flag=True, help="Will only dump to S3 if commit flag is present")
+def generate_from_export(source, bucket, exclude_fields, dump_prefix, shard_by, commit):
+    """
+    Generates the report from a DynamoDB export of the Current S3 table -- without scanning the table.
+    SOURCE is the local directory or the S3 location (s3://bucket/prefix/) of the export.
+    """
+    if not commit:
+        log.warning("[@] COMMIT FLAG NOT SET -- NOT SAVING ANYTHING TO S3!")
+    build_report_from_export(source, commit=commit)
+
+
+@cli.command("compact-deltas")
+@click.option("--bucket", type=click.STRING, required=True, help="Comma separated list of S3 bucket that the report "
+                                                                 "is saved to.", callback=get_bucket)
+@click.option("--dump-prefix", type=click.STRING, required=False, default="historical-s3-report.json",
+              callback=get_dump_prefix)
+@click.option("--retention", type=click.IntRange(min=0), required=False, default=24 * 60 * 60,
+              help="Deltas older than this (in seconds) are folded into a snapshot.", callback=get_delta_retention)
+def compact(bucket, dump_prefix, retention):
+    """Folds the old deltas of the report into a snapshot."""
+    compact_deltas()
@@ -0,0 +1,114 @@
+"""
+.. module: historical_reports.s3.compression
+    :platform: Unix
+    :copyright: (c) 2017 by Netflix Inc., see AUTHORS for more
+    :license: Apache, see LICENSE for more details.
+.. author:: Mike Grima <mgrima@netflix.com>
+
+Compression for the report objects. `CONFIG.compression` picks the encoding that the reports are saved with:
+- Not set (the default) -- the reports are saved uncompressed.
+- `gzip`
+- `zstd` -- requires the `zstandard` library to be installed.
+
+The encoding is saved as the `Content-Encoding` of the S3 object (the key and `Content-Type` are unchanged), and the
+reports are transparently decompressed when they are fetched.
+"""
+import zlib
+
+from historical_reports.s3.config import CONFIG
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+ENCODINGS = ["gzip", "zstd"]
+
+# zlib's `wbits` for the gzip container format:
+GZIP_WBITS = 16 + zlib.MAX_WBITS
+
+
+def get_encoding(encoding=None):
+    """
+    Returns the `Content-Encoding` that the reports are saved with, or None if they are not compressed.
+    :param encoding: Defaults to `CONFIG.compression`.
+    """
+    encoding = encoding if encoding is not None else CONFIG.compression
+    if not encoding:
+        return None
+
+    if encoding not in ENCODINGS:
+        raise ValueError(f"Unknown compression: {encoding}. Must be one of: {', '.join(ENCODINGS)}.")
+
+    if encoding == "zstd" and not zstandard:
+        raise ValueError("The zstd compression requires the `zstandard` library to be installed.")
+
+    return encoding
+
+
+def get_compressor(encoding):
+    """Returns a streaming compressor (with `compress(data)` and `flush()`) for the encoding."""
+    if encoding == "gzip":
+        return zlib.compressobj(zlib.Z_DEFAULT_COMPRESSION, zlib.DEFLATED, GZIP_WBITS)
+
+    return zstandard.ZstdCompressor().compressobj()
+
+
+def compress(data, encoding):
+    compressor = get_compressor(encoding)
+    return compressor.compress(data) + compressor.flush()
+
+
+def decompress(data, encoding):
+    """Decompresses the data based on the `Content-Encoding` of the object. Anything else is returned as-is."""
+    if encoding == "gzip":
+        return zlib.decompress(data, GZIP_WBITS)
+
+    if encoding == "zstd":
+        if not zstandard:
+            raise ValueError("The report is zstd compressed -- the `zstandard` library must be installed to read it.")
+
+        # The streamed frames don't record the content size, so this can't be a plain `decompress()`:
+        return zstandard.ZstdDecompressor().decompressobj().decompress(data)
+
+    return data
+
+
+def get_decompressor(encoding):
+    """Returns a streaming decompressor (with `decompress(data)`) for the `Content-Encoding` of the object."""
+    if encoding == "gzip":
+        return zlib.decompressobj(GZIP_WBITS)
+
+    if not zstandard:
+        raise ValueError("The report is zstd compressed -- the `zstandard` library must be installed to read it.")
+
+    return zstandard.ZstdDecompressor().decompressobj()
+
+
+class DecompressingReader:
+    """Read-only, file-like wrapper that decompresses a binary stream as it is read."""
+    def __init__(self, stream, encoding):
+        self.stream = stream
+        self._decompressor = get_decompressor(encoding)
+
+    def read(self, size=-1):
+        # The compressed chunks can decompress to nothing, so keep going until there is something (or the end):
+        while True:
+            chunk = self.stream.read(size)
+            if not chunk:
+                return b""
+
+            data = self._decompressor.decompress(chunk)
+            if data:
+                return data
+
+    def close(self):
+        self.stream.close()
+
+
+def open_decompressed(stream, encoding):
+    """Wraps the stream so that it is decompressed based on the `Content-Encoding` of the object."""
+    if encoding in ENCODINGS:
+        return DecompressingReader(stream, encoding)
+
+    return stream
@@ -5,6 +5,7 @@
     :license: Apache, see LICENSE for more details.
 .. author:: Mike Grima <mgrima@netflix.com>
 """
+import json
 import os
 
 
@@ -28,6 +29,30 @@ class Config:
         self._import_bucket = os.environ.get("IMPORT_BUCKET", None)
         self._import_prefix = os.environ.get("IMPORT_PREFIX", "historical-s3-report.json")
         self._export_if_missing = os.environ.get("EXPORT_IF_MISSING", False)
+        self._scan_segments = int(os.environ.get("SCAN_SEGMENTS", 1))
+        self._scan_rate_limit = float(os.environ.get("SCAN_RATE_LIMIT", 0))  # Read capacity units per second
+        self._multipart_chunk_size = int(os.environ.get("MULTIPART_CHUNK_SIZE", 8 * 1024 * 1024))  # Min is 5MB
+        self._upload_workers = int(os.environ.get("UPLOAD_WORKERS", 1))
+        self._replicate_with_copy = os.environ.get("REPLICATE_WITH_COPY", False)
+        self._max_pool_connections = int(os.environ.get("MAX_POOL_CONNECTIONS", 10))
+        self._shard_by = [field for field in os.environ.get("SHARD_BY", "").split(",") if field]
+        self._json_backend = os.environ.get("JSON_BACKEND", "auto")
+        self._compact_report = os.environ.get("COMPACT_REPORT", False)
+        self._compression = os.environ.get("COMPRESSION", None)  # Either gzip or zstd
+        self._checkpoint = os.environ.get("CHECKPOINT", False)
+        self._staging_prefix = os.environ.get("STAGING_PREFIX", "historical-s3-report-staging")
+        self._checkpoint_items = int(os.environ.get("CHECKPOINT_ITEMS", 5000))
+        self._checkpoint_margin = int(os.environ.get("CHECKPOINT_MARGIN", 60 * 1000))  # In milliseconds
+        self._invoker = os.environ.get("INVOKER", "lambda")
+        self._function_name = os.environ.get("AWS_LAMBDA_FUNCTION_NAME", None)
+        self._report_views = json.loads(os.environ.get("REPORT_VIEWS", "[]"))  # See `generate.dump_report_views`
+        self._indexes = os.environ.get("INDEXES", False)
+        self._offset_index = os.environ.get("OFFSET_INDEX", False)
+        self._deltas = os.environ.get("DELTAS", False)
+        self._delta_retention = int(os.environ.get("DELTA_RETENTION", 24 * 60 * 60))  # In seconds
+        self._skip_unchanged = os.environ.get("SKIP_UNCHANGED", False)
+        self._pipeline = os.environ.get("PIPELINE", False)
+        self._stream_updates = os.environ.get("STREAM_UPDATES", False)
 
     @property
     def s3_reports_version(self):
@@ -89,5 +114,197 @@ class Config:
     def export_if_missing(self, toggle):
         self._export_if_missing = toggle
 
+    @property
+    def scan_segments(self):
+        return self._scan_segments
+
+    @scan_segments.setter
+    def scan_segments(self, segments):
+        self._scan_segments = segments
+
+    @property
+    def scan_rate_limit(self):
+        return self._scan_rate_limit
+
+    @scan_rate_limit.setter
+    def scan_rate_limit(self, rate_limit):
+        self._scan_rate_limit = rate_limit
+
+    @property
+    def multipart_chunk_size(self):
+        return self._multipart_chunk_size
+
+    @multipart_chunk_size.setter
+    def multipart_chunk_size(self, size):
+        self._multipart_chunk_size = size
+
+    @property
+    def upload_workers(self):
+        return self._upload_workers
+
+    @upload_workers.setter
+    def upload_workers(self, workers):
+        self._upload_workers = workers
+
+    @property
+    def replicate_with_copy(self):
+        return self._replicate_with_copy
+
+    @replicate_with_copy.setter
+    def replicate_with_copy(self, toggle):
+        self._replicate_with_copy = toggle
+
+    @property
+    def max_pool_connections(self):
+        return self._max_pool_connections
+
+    @max_pool_connections.setter
+    def max_pool_connections(self, connections):
+        self._max_pool_connections = connections
+
+    @property
+    def shard_by(self):
+        return self._shard_by
+
+    @shard_by.setter
+    def shard_by(self, fields):
+        self._shard_by = fields
+
+    @property
+    def json_backend(self):
+        return self._json_backend
+
+    @json_backend.setter
+    def json_backend(self, backend):
+        self._json_backend = backend
+
+    @property
+    def compact_report(self):
+        return self._compact_report
+
+    @compact_report.setter
+    def compact_report(self, toggle):
+        self._compact_report = toggle
+
+    @property
+    def compression(self):
+        return self._compression
+
+    @compression.setter
+    def compression(self, encoding):
+        self._compression = encoding
+
+    @property
+    def checkpoint(self):
+        return self._checkpoint
+
+    @checkpoint.setter
+    def checkpoint(self, toggle):
+        self._checkpoint = toggle
+
+    @property
+    def staging_prefix(self):
+        return self._staging_prefix
+
+    @staging_prefix.setter
+    def staging_prefix(self, prefix):
+        self._staging_prefix = prefix
+
+    @property
+    def checkpoint_items(self):
+        return self._checkpoint_items
+
+    @checkpoint_items.setter
+    def checkpoint_items(self, items):
+        self._checkpoint_items = items
+
+    @property
+    def checkpoint_margin(self):
+        return self._checkpoint_margin
+
+    @checkpoint_margin.setter
+    def checkpoint_margin(self, margin):
+        self._checkpoint_margin = margin
+
+    @property
+    def invoker(self):
+        return self._invoker
+
+    @invoker.setter
+    def invoker(self, invoker):
+        self._invoker = invoker
+
+    @property
+    def function_name(self):
+        return self._function_name
+
+    @function_name.setter
+    def function_name(self, name):
+        self._function_name = name
+
+    @property
+    def report_views(self):
+        return self._report_views
+
+    @report_views.setter
+    def report_views(self, views):
+        self._report_views = views
+
+    @property
+    def indexes(self):
+        return self._indexes
+
+    @indexes.setter
+    def indexes(self, toggle):
+        self._indexes = toggle
+
+    @property
+    def offset_index(self):
+        return self._offset_index
+
+    @offset_index.setter
+    def offset_index(self, toggle):
+        self._offset_index = toggle
+
+    @property
+    def deltas(self):
+        return self._deltas
+
+    @deltas.setter
+    def deltas(self, toggle):
+        self._deltas = toggle
+
+    @property
+    def delta_retention(self):
+        return self._delta_retention
+
+    @delta_retention.setter
+    def delta_retention(self, seconds):
+        self._delta_retention = seconds
+
+    @property
+    def skip_unchanged(self):
+        return self._skip_unchanged
+
+    @skip_unchanged.setter
+    def skip_unchanged(self, toggle):
+        self._skip_unchanged = toggle
+
+    @property
+    def pipeline(self):
+        return self._pipeline
+
+    @pipeline.setter
+    def pipeline(self, toggle):
+        self._pipeline = toggle
+
+    @property
+    def stream_updates(self):
+        return self._stream_updates
+
+    @stream_updates.setter
+    def stream_updates(self, toggle):
+        self._stream_updates = toggle
+
 
 CONFIG = Config()
@@ -0,0 +1,158 @@
+"""
+.. module: historical_reports.s3.deltas
+    :platform: Unix
+    :copyright: (c) 2017 by Netflix Inc., see AUTHORS for more
+    :license: Apache, see LICENSE for more details.
+.. author:: Mike Grima <mgrima@netflix.com>
+
+Delta (changelog) objects of the report. When `CONFIG.deltas` is set, each batch of records that is applied to the
+report also saves a small, time-ordered delta object under the report prefix (without the extension):
+```
+historical-s3-report/deltas/20181018T101010123456Z.json
+historical-s3-report/deltas/snapshots/20181017T101010123456Z.json
+```
+Each delta lists the buckets that were added, modified (with their new entries), and deleted. Consumers can then keep
+up with the report by fetching the deltas that are newer than the last one that they applied -- instead of
+re-downloading the whole report.
+
+`compact_deltas` folds the deltas that are older than `CONFIG.delta_retention` into a single snapshot (with the same
+fields as a delta), named after the newest delta that went into it. Consumers apply the snapshots and the deltas in
+the order of their timestamps.
+(Deltas are not saved for the full reports, nor for the sharded report layout.)
+"""
+import logging
+import os
+from datetime import datetime, timedelta
+
+from historical.constants import LOGGING_LEVEL
+
+from historical_reports.s3.config import CONFIG
+from historical_reports.s3.json_backend import dumps, loads
+from historical_reports.s3.models import get_generated_time
+from historical_reports.s3.util import delete_objects, dump_to_s3, get_bucket_client, get_sibling_prefix, \
+    _get_from_s3
+
+logging.basicConfig()
+log = logging.getLogger('historical-reports-s3')
+log.setLevel(LOGGING_LEVEL)
+
+# The `report_action` of the (scheduled) event that compacts the deltas:
+COMPACT_DELTAS = "compact_deltas"
+
+# The delta keys are named by the (UTC) time that they were made, so they list out in order:
+DELTA_TIME_FORMAT = "%Y%m%dT%H%M%S%fZ"
+
+
+def get_deltas_prefix(prefix=None):
+    """Returns the S3 prefix of the deltas, which live under the report prefix (without the extension)."""
+    return get_sibling_prefix("deltas/", prefix)
+
+
+def get_delta_key(timestamp, prefix=None, snapshot=False):
+    return f"{get_deltas_prefix(prefix)}{'snapshots/' if snapshot else ''}{timestamp}.json"
+
+
+def diff_changes(changes, previous, buckets):
+    """
+    Works out the delta of the batch of records that was applied to the report.
+    :param changes: Dict of the serialized entries of the buckets that were added or modified.
+    :param previous: The names of the buckets in the batch that were in the report before the batch was applied.
+    :param buckets: The report's bucket entries -- after the deletions were applied, but before the `changes` were.
+    :return: A tuple of the added `{name: details}`, the modified `{name: details}`, and the deleted names.
+    """
+    added = {name: details for name, details in changes.items() if name not in previous}
+    modified = {name: details for name, details in changes.items() if name in previous}
+    deleted = sorted(name for name in previous if name not in buckets and name not in changes)
+
+    return added, modified, deleted
+
+
+def dump_delta(added, modified, deleted, generated_date, etags=None, prefix=None):
+    """
+    Saves the delta object to S3 (nothing is saved if nothing changed).
+    :param generated_date: The `generated_date` of the report that the delta was applied to.
+    :param etags: The `{bucket: ETag}` of the saved report (from the `S3StreamingUpload`).
+    :param prefix: The prefix of the report. Defaults to `CONFIG.dump_to_prefix`.
+    :return: The key of the delta, or None if it was not saved.
+    """
+    if not added and not modified and not deleted:
+        log.debug("[/] No changes to the report -- not saving a delta.")
+        return None
+
+    key = get_delta_key(datetime.utcnow().strftime(DELTA_TIME_FORMAT), prefix)
+    log.debug(f"[-->] Saving the delta: {key} to S3.")
+    document = {"s3_report_version": CONFIG.s3_reports_version, "generated_date": generated_date,
+                "etags": etags or {}, "added": added, "modified": modified, "deleted": deleted}
+    dump_to_s3(dumps(document).encode("utf-8"), prefix=key)
+
+    return key
+
+
+def fold_delta(snapshot, delta):
+    """Folds the (newer) delta into the snapshot, so that the snapshot has the net changes of both."""
+    for name, details in delta["added"].items():
+        # A bucket that was deleted and then re-created was modified:
+        if name in snapshot["deleted"]:
+            snapshot["deleted"].remove(name)
+            snapshot["modified"][name] = details
+        else:
+            snapshot["added"][name] = details
+
+    for name, details in delta["modified"].items():
+        if name in snapshot["added"]:
+            snapshot["added"][name] = details
+        else:
+            snapshot["modified"][name] = details
+
+    for name in delta["deleted"]:
+        # A bucket that was added and then deleted was never there to begin with:
+        if snapshot["added"].pop(name, None) is None:
+            snapshot["modified"].pop(name, None)
+            snapshot["deleted"].add(name)
+
+    snapshot["generated_date"] = delta["generated_date"]
+    snapshot["etags"] = delta["etags"]
+
+
+def list_deltas(prefix=None):
+    """Lists the keys of the deltas (not the snapshots) in the first dump bucket, oldest first."""
+    bucket = CONFIG.dump_to_buckets[0]
+    deltas_prefix = get_deltas_prefix(prefix)
+    paginator = get_bucket_client(bucket).get_paginator("list_objects_v2")
+
+    return sorted(obj["Key"] for page in paginator.paginate(Bucket=bucket, Prefix=deltas_prefix, Delimiter="/")
+                  for obj in page.get("Contents", []))
+
+
+def compact_deltas(before=None, prefix=None):
+    """
+    Folds the old deltas into a snapshot, and deletes them.
+    :param before: Only deltas older than this (UTC) datetime are folded. Defaults to `CONFIG.delta_retention` ago.
+    :param prefix: The prefix of the report. Defaults to `CONFIG.dump_to_prefix`.
+    :return: The key of the snapshot, or None if there was nothing to compact.
+    """
+    before = before or datetime.utcnow() - timedelta(seconds=CONFIG.delta_retention)
+    cutoff = get_delta_key(before.strftime(DELTA_TIME_FORMAT), prefix)
+    keys = [key for key in list_deltas(prefix) if key < cutoff]
+    if not keys:
+        log.debug("[/] No deltas to compact.")
+        return None
+
+    log.debug(f"[@] Compacting {len(keys)} deltas into a snapshot.")
+    bucket = CONFIG.dump_to_buckets[0]
+    client = get_bucket_client(bucket)
+    snapshot = {"added": {}, "modified": {}, "deleted": set()}
+    for key in keys:
+        delta, _ = _get_from_s3(client, bucket, key)
+        fold_delta(snapshot, loads(delta))
+
+    # The snapshot is keyed by the newest delta that went into it:
+    snapshot_key = get_delta_key(os.path.splitext(os.path.basename(keys[-1]))[0], prefix, snapshot=True)
+    snapshot.update({"s3_report_version": CONFIG.s3_reports_version, "deleted": sorted(snapshot["deleted"]),
+                     "compacted_date": get_generated_time()})
+    dump_to_s3(dumps(snapshot).encode("utf-8"), prefix=snapshot_key)
+    for bucket in CONFIG.dump_to_buckets:
+        delete_objects(bucket, keys)
+
+    log.debug(f"[@] Saved the snapshot: {snapshot_key}.")
+    return snapshot_key
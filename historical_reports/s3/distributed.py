@@ -0,0 +1,196 @@
+"""
+.. module: historical_reports.s3.distributed
+    :platform: Unix
+    :copyright: (c) 2017 by Netflix Inc., see AUTHORS for more
+    :license: Apache, see LICENSE for more details.
+.. author:: Mike Grima <mgrima@netflix.com>
+
+The fan-out/fan-in (distributed) full report. This is made up of 3 types of events (see `handle_event`):
+1. The coordinator (`{"report_action": "coordinate", "total_segments": N}`) splits the Current S3 table up into N scan
+   segments, and invokes a worker for each.
+2. Each worker (`scan_segment`) scans its segment, and saves the buckets as a partial report under the staging prefix:
+   ```
+   historical-s3-report-staging/<build ID>/segments/00000.json
+   ...
+   ```
+   The last worker to finish invokes the reducer.
+3. The reducer (`reduce`) merges all of the partial reports into the final report, and deletes the staged objects.
+
+The invocations are made with the `CONFIG.invoker`:
+- `lambda` (the default) -- asynchronously invokes the Lambda function (`CONFIG.function_name`).
+- `local` -- calls the handler in-process. This is for testing and for running outside of Lambda.
+"""
+import json
+import logging
+import uuid
+
+import boto3
+from historical.constants import LOGGING_LEVEL
+
+from historical_reports.s3.checkpoint import delete_staged, get_staging_bucket, get_staging_key, list_staged
+from historical_reports.s3.config import CONFIG
+from historical_reports.s3.generate import _scan
+from historical_reports.s3.indexes import dump_indexes, new_indexes
+from historical_reports.s3.json_backend import loads
+from historical_reports.s3.models import get_generated_time
+from historical_reports.s3.serialize import BucketSerializer, ReportWriter
+from historical_reports.s3.util import get_bucket_client, S3StreamingUpload, _get_from_s3
+
+logging.basicConfig()
+log = logging.getLogger('historical-reports-s3')
+log.setLevel(LOGGING_LEVEL)
+
+COORDINATE = "coordinate"
+SCAN_SEGMENT = "scan_segment"
+REDUCE = "reduce"
+
+
+class LambdaInvoker:
+    """Asynchronously invokes the report Lambda function with the event."""
+    def __init__(self, context=None):
+        self.function_name = CONFIG.function_name or (context.invoked_function_arn if context else None)
+
+    def invoke(self, event):
+        log.debug(f"[-->] Invoking {self.function_name} with a {event['report_action']} event.")
+        boto3.client("lambda", region_name=CONFIG.current_region).invoke(
+            FunctionName=self.function_name, InvocationType="Event", Payload=json.dumps(event).encode("utf-8"))
+
+
+class LocalInvoker:
+    """In-process stand-in for the `LambdaInvoker`. The handler is called right away (and not asynchronously)."""
+    def __init__(self, context=None):
+        self.context = context
+        self.events = []
+
+    def invoke(self, event):
+        # Imported here as the entrypoints import this module:
+        from historical_reports.s3.entrypoints import handler
+
+        log.debug(f"[-->] Running a {event['report_action']} event in-process.")
+        self.events.append(event)
+        handler(event, self.context)
+
+
+INVOKERS = {
+    "lambda": LambdaInvoker,
+    "local": LocalInvoker
+}
+
+
+def get_invoker(context=None):
+    if CONFIG.invoker not in INVOKERS:
+        raise ValueError(f"Unknown invoker: {CONFIG.invoker}. Must be one of: {', '.join(INVOKERS)}.")
+
+    return INVOKERS[CONFIG.invoker](context)
+
+
+def get_segments_prefix(build_id):
+    return get_staging_key(f"{build_id}/segments/")
+
+
+def get_segment_key(build_id, segment):
+    return f"{get_segments_prefix(build_id)}{segment:05d}.json"
+
+
+def _child_event(event, report_action, **kwargs):
+    """Makes the event for the next step -- any `config` overrides are passed along with it."""
+    child = {"report_action": report_action, "config": event.get("config", {})}
+    child.update({key: event[key] for key in ["build_id", "total_segments", "generated_date"] if key in event})
+    child.update(kwargs)
+
+    return child
+
+
+class _SegmentsMerged(Exception):
+    """Raised when the segments are deleted by another reducer in the middle of the merge."""
+
+
+def coordinate(event, invoker):
+    """Splits the table up into the segments, and invokes a worker for each."""
+    total_segments = int(event.get("total_segments") or CONFIG.scan_segments)
+    event = dict(event, build_id=event.get("build_id") or uuid.uuid4().hex, total_segments=total_segments,
+                 generated_date=get_generated_time())
+
+    log.debug(f"[@] Starting the distributed report: {event['build_id']} with {total_segments} segments.")
+    for segment in range(total_segments):
+        invoker.invoke(_child_event(event, SCAN_SEGMENT, segment=segment))
+
+
+def scan_segment(event, invoker):
+    """Scans the segment of the table into a partial report. The last worker to finish invokes the reducer."""
+    build_id, segment, total_segments = event["build_id"], event["segment"], event["total_segments"]
+    serializer = BucketSerializer()
+
+    log.debug(f"[@] Scanning segment {segment + 1}/{total_segments} of the distributed report: {build_id}.")
+    with S3StreamingUpload(buckets=[get_staging_bucket()], prefix=get_segment_key(build_id, segment)) as upload:
+        writer = ReportWriter(upload, generated_date=event["generated_date"], compact=True)
+        writer.start()
+        for item in _scan(segment=segment, total_segments=total_segments):
+            writer.write_bucket(*serializer(item))
+
+        writer.finish()
+
+    # If all of the segments are now saved, then this is the last worker:
+    if len(list_staged(get_segments_prefix(build_id))) == total_segments:
+        invoker.invoke(_child_event(event, REDUCE))
+
+
+def reduce(event):
+    """
+    Merges all of the partial reports into the final report.
+
+    More than 1 worker can see that all of the segments are saved (if they finish at the same time), so this can run
+    more than once. That is harmless -- a reducer that finds that the segments were already merged and deleted does
+    nothing. If the segments are deleted while a reducer is still merging them, then that reducer aborts its upload
+    (the report was already saved by the reducer that deleted them).
+    """
+    build_id, total_segments = event["build_id"], event["total_segments"]
+    keys = sorted(list_staged(get_segments_prefix(build_id)))
+    if len(keys) != total_segments:
+        log.info(f"[/] The segments of the distributed report: {build_id} were already merged. Skipping.")
+        return
+
+    log.debug(f"[-->] Merging the {total_segments} segments of the distributed report: {build_id}. Saving to S3.")
+    bucket = get_staging_bucket()
+    client = get_bucket_client(bucket)
+    indexes = new_indexes()
+    try:
+        with S3StreamingUpload() as upload:
+            writer = ReportWriter(upload, generated_date=event["generated_date"], indexes=indexes)
+            writer.start()
+
+            # Only 1 partial report is held in memory at a time:
+            for key in keys:
+                partial, _ = _get_from_s3(client, bucket, key)
+                if partial is None:
+                    raise _SegmentsMerged()
+
+                for name, details in loads(partial)["buckets"].items():
+                    writer.write_bucket(name, details)
+
+            writer.finish()
+
+    except _SegmentsMerged:
+        log.info(f"[/] The segments of the distributed report: {build_id} were merged by another reducer. Aborted.")
+        return
+
+    if not upload.unchanged:
+        dump_indexes(indexes, event["generated_date"], etags=upload.etags, skipped=upload.skipped)
+
+    delete_staged(keys)
+    log.debug(f"[@] Completed the distributed report: {build_id}.")
+
+
+def handle_event(event, context=None):
+    """Handles the coordinator, worker and reducer events for the distributed report."""
+    invoker = get_invoker(context)
+    report_action = event["report_action"]
+
+    if report_action == COORDINATE:
+        coordinate(event, invoker)
+    elif report_action == SCAN_SEGMENT:
+        scan_segment(event, invoker)
+    elif report_action == REDUCE:
+        reduce(event)
+    else:
+        raise ValueError(f"Unknown report action: {report_action}.")
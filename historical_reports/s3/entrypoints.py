@@ -12,6 +12,8 @@ from historical.common.util import deserialize_records
 
 from raven_python_lambda import RavenLambdaWrapper
 
+from historical_reports.s3.deltas import compact_deltas, COMPACT_DELTAS
+from historical_reports.s3.distributed import handle_event
 from historical_reports.s3.generate import dump_report
 from historical_reports.s3.update import update_records
 from historical_reports.s3.util import set_config_from_input
@@ -25,7 +27,8 @@ log.setLevel(LOGGING_LEVEL)
 def handler(event, context):
     """
     Historical S3 report generator lambda handler. This will handle both scheduled events as well as dynamo stream
-    events.
+    events -- and the events for the distributed report (see `historical_reports.s3.distributed`), and the events that
+    compact the deltas (see `historical_reports.s3.deltas`).
     """
     set_config_from_input(event)
 
@@ -39,7 +42,15 @@ def handler(event, context):
         # Update event:
         update_records(records)
 
+    elif event.get("report_action") == COMPACT_DELTAS:
+        log.debug('[@] Received an event to compact the deltas.')
+        compact_deltas()
+
+    elif event.get("report_action"):
+        log.debug('[@] Received a {} event for the distributed report.'.format(event["report_action"]))
+        handle_event(event, context)
+
     else:
         log.debug('[@] Received a scheduled event for a full report.')
         # Generate event:
-        dump_report()
+        dump_report(context=context)
@@ -0,0 +1,95 @@
+"""
+.. module: historical_reports.s3.export
+    :platform: Unix
+    :copyright: (c) 2017 by Netflix Inc., see AUTHORS for more
+    :license: Apache, see LICENSE for more details.
+.. author:: Mike Grima <mgrima@netflix.com>
+
+Builds the report from a DynamoDB export of the Current S3 table (in the `DYNAMODB_JSON` export format) -- instead of
+scanning the live table. The export data files are gzipped, with one `{"Item": {...}}` in DynamoDB JSON per line.
+The source is either a local directory, or an S3 location (`s3://bucket/prefix/`) of an export. The files are streamed
+line by line, so only one item is held in memory at a time.
+"""
+import gzip
+import json
+import logging
+import os
+from urllib.parse import urlparse
+
+from boto3.dynamodb.types import TypeDeserializer
+from historical.constants import LOGGING_LEVEL
+
+from historical_reports.s3.generate import save_report
+from historical_reports.s3.serialize import ITEM_ATTRIBUTES
+from historical_reports.s3.util import get_bucket_client
+
+logging.basicConfig()
+log = logging.getLogger('historical-reports-s3')
+log.setLevel(LOGGING_LEVEL)
+
+# The export's data files (its manifest files are not gzipped):
+EXPORT_FILE_SUFFIX = ".json.gz"
+
+
+def _open_local_files(directory):
+    for root, _, files in sorted(os.walk(directory)):
+        for name in sorted(files):
+            if name.endswith(EXPORT_FILE_SUFFIX):
+                log.debug(f"[@] Reading export file: {os.path.join(root, name)}")
+                yield open(os.path.join(root, name), "rb")
+
+
+def _open_s3_files(bucket, prefix):
+    client = get_bucket_client(bucket)
+    for page in client.get_paginator("list_objects_v2").paginate(Bucket=bucket, Prefix=prefix):
+        for obj in page.get("Contents", []):
+            if obj["Key"].endswith(EXPORT_FILE_SUFFIX):
+                log.debug(f"[@] Reading export file: s3://{bucket}/{obj['Key']}")
+                yield client.get_object(Bucket=bucket, Key=obj["Key"])["Body"]
+
+
+def open_export_files(source):
+    """
+    Opens all of the data files of the export.
+    :param source: A local directory, or an S3 location (`s3://bucket/prefix/`).
+    :return: An iterable of the (binary, file-like) gzipped data files.
+    """
+    if source.startswith("s3://"):
+        location = urlparse(source)
+        return _open_s3_files(location.netloc, location.path.lstrip("/"))
+
+    if not os.path.isdir(source):
+        raise ValueError(f"The export source: {source} is not a directory or an S3 location.")
+
+    return _open_local_files(source)
+
+
+def read_export_items(source):
+    """
+    Streams the items out of the export.
+    :param source: A local directory, or an S3 location (`s3://bucket/prefix/`).
+    :return: An iterable of the item dicts, with the attributes that are needed for the report (like `item_to_dict`).
+    """
+    deserializer = TypeDeserializer()
+    for file in open_export_files(source):
+        with gzip.GzipFile(fileobj=file) as lines:
+            for line in lines:
+                if not line.strip():
+                    continue
+
+                item = json.loads(line)["Item"]
+                yield {name: deserializer.deserialize(item[name]) if name in item else None
+                       for name in ITEM_ATTRIBUTES}
+
+        file.close()
+
+
+def build_report_from_export(source, commit=True):
+    """
+    Generates the full report from the DynamoDB export of the Current S3 table.
+    :param source: A local directory, or an S3 location (`s3://bucket/prefix/`).
+    :param commit: Only saves the report to S3 if set.
+    """
+    log.debug(f"[@] Starting... Building the report from the export at: {source}.")
+    save_report(read_export_items(source), commit=commit)
+    log.debug("[@] Completed S3 report generation.")
@@ -5,34 +5,393 @@
     :license: Apache, see LICENSE for more details.
 .. author:: Mike Grima <mgrima@netflix.com>
 """
-import json
 import logging
+import os
+import queue
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import ExitStack
 
 from historical.constants import LOGGING_LEVEL
 from historical.s3.models import CurrentS3Model
+from pynamodb.pagination import ResultIterator
 
-from historical_reports.s3.models import S3ReportSchema
-from historical_reports.s3.util import dump_to_s3
+from historical_reports.s3.checkpoint import delete_staging, iterate_parts, load_state, new_state, save_checkpoint
+from historical_reports.s3.config import CONFIG
+from historical_reports.s3.indexes import dump_indexes, new_indexes
+from historical_reports.s3.serialize import BucketSerializer, ReportWriter, get_projection, item_to_dict, \
+    write_report
+from historical_reports.s3.shards import add_shard, dump_manifest, get_shard, get_shard_prefix, new_manifest, \
+    SHARD_FIELDS
+from historical_reports.s3.util import S3StreamingUpload
 
 logging.basicConfig()
 log = logging.getLogger('historical-reports-s3')
 log.setLevel(LOGGING_LEVEL)
 
+# The longest that a rate limited scan will sleep for between pages (or when throttled):
+MAX_SCAN_SLEEP = 10
+
+# The number of consecutive throttling errors that a rate limited scan will back off and retry on before giving up:
+MAX_SCAN_THROTTLES = 30
+
+# The number of scanned items that can be waiting to be serialized before the segment scanners will block:
+MAX_PENDING_ITEMS = 1000
+
+# The scanned items are handed over to the serializer in batches of this many (rather than one at a time):
+SCAN_BATCH_SIZE = 100
+
+_SEGMENT_COMPLETE = object()
+
+
+def _scan(segment=None, total_segments=None, last_evaluated_key=None, exclude_fields=None):
+    """
+    Scans the Current S3 table for only the attributes that are needed for the report (see `get_projection`), so that
+    the rest never leave DynamoDB. PynamoDB's `Model.scan` can't take a projection, so this goes through the table
+    connection directly.
+
+    If `CONFIG.scan_rate_limit` is set, then the scan is rate limited to that many read capacity units per second
+    (split evenly between the segments), so that the report doesn't compete with the Historical collectors for the
+    table's read capacity. The pace is set by the `ConsumedCapacity` of each page, and throttling errors are backed
+    off from and retried.
+    :param last_evaluated_key: If supplied, the scan resumes after this key.
+    :param exclude_fields: The report fields that are excluded (for the projection). Defaults to
+                           `CONFIG.exclude_fields`.
+    """
+    projection = get_projection(exclude_fields=exclude_fields)
+    if CONFIG.scan_rate_limit:
+        rate_limit = CONFIG.scan_rate_limit / (total_segments or 1)
+        return CurrentS3Model.rate_limited_scan(attributes_to_get=projection, segment=segment,
+                                                total_segments=total_segments, last_evaluated_key=last_evaluated_key,
+                                                page_size=max(1, int(rate_limit)),
+                                                read_capacity_to_consume_per_second=rate_limit,
+                                                max_sleep_between_retry=MAX_SCAN_SLEEP,
+                                                max_consecutive_exceptions=MAX_SCAN_THROTTLES)
+
+    scan_kwargs = dict(attributes_to_get=projection, segment=segment, total_segments=total_segments,
+                       exclusive_start_key=last_evaluated_key)
+    return ResultIterator(CurrentS3Model._get_connection().scan, (), scan_kwargs,
+                          map_fn=CurrentS3Model.from_raw_data)
+
+
+def _put(items, item, stop):
+    """Places the item on the queue -- unless the consumer has stopped. Returns whether the item was queued."""
+    while not stop.is_set():
+        try:
+            items.put(item, timeout=1)
+            return True
+        except queue.Full:
+            continue
+
+    return False
+
+
+def _scan_segment(segment, total_segments, items, stop, exclude_fields=None):
+    """Scans a single segment of the Current S3 table onto the items queue."""
+    log.debug(f"[@] Scanning segment {segment + 1}/{total_segments}.")
+    try:
+        batch = []
+        for item in _scan(segment=segment, total_segments=total_segments, exclude_fields=exclude_fields):
+            batch.append(item)
+            if len(batch) >= SCAN_BATCH_SIZE:
+                if not _put(items, batch, stop):
+                    return
+
+                batch = []
+
+        if batch and not _put(items, batch, stop):
+            return
+
+    except Exception as e:
+        log.error(f"[X] Failed to scan segment {segment + 1}/{total_segments}: {e}")
+        _put(items, e, stop)
+        return
+
+    log.debug(f"[+] Completed segment {segment + 1}/{total_segments}.")
+    _put(items, _SEGMENT_COMPLETE, stop)
+
+
+def _parallel_scan(total_segments, exclude_fields=None):
+    items = queue.Queue(maxsize=max(1, MAX_PENDING_ITEMS // SCAN_BATCH_SIZE))
+    stop = threading.Event()
+
+    with ThreadPoolExecutor(max_workers=total_segments) as executor:
+        for segment in range(total_segments):
+            executor.submit(_scan_segment, segment, total_segments, items, stop, exclude_fields=exclude_fields)
+
+        try:
+            remaining = total_segments
+            while remaining:
+                item = items.get()
+                if item is _SEGMENT_COMPLETE:
+                    remaining -= 1
+                elif isinstance(item, Exception):
+                    raise item
+                else:
+                    yield from item
+
+        finally:
+            stop.set()
+
+
+def scan_buckets(total_segments=None, exclude_fields=None):
+    """
+    Scans the Current S3 table for all the buckets.
+
+    If more than 1 segment is configured, then the table is split up with the DynamoDB `Segment`/`TotalSegments`
+    parameters, and each segment is scanned in parallel on its own worker thread. The items are streamed back
+    as they arrive.
+
+    If `CONFIG.pipeline` is set, then a single segment is also scanned on a worker thread. The scan then runs at the
+    same time as the serialization (which in turn runs at the same time as the part uploads -- see
+    `S3StreamingUpload`), with bounded queues in between. The report then takes about as long as its slowest stage,
+    rather than the sum of them.
+    :param total_segments: Overrides `CONFIG.scan_segments` if supplied.
+    :param exclude_fields: The report fields that are excluded (for the projection). Defaults to
+                           `CONFIG.exclude_fields`.
+    :return: An iterable of all the items in the table.
+    """
+    total_segments = total_segments or CONFIG.scan_segments
+
+    if total_segments <= 1 and not CONFIG.pipeline:
+        return _scan(exclude_fields=exclude_fields)
+
+    log.debug(f"[@] Performing a parallel scan with {total_segments} segments.")
+    return _parallel_scan(total_segments, exclude_fields=exclude_fields)
+
+
+def dump_sharded_report(all_buckets, commit=True):
+    """
+    Streams out the report split up into shards (see `historical_reports.s3.shards`), followed by the manifest.
+
+    Each shard is streamed to S3 as the scan comes in. The shards are saved when the scan is complete, and the
+    manifest is only saved once all of the shards have been saved.
+    """
+    manifest = new_manifest()
+    serializer = BucketSerializer()
+    writers = {}
+
+    with ExitStack() as stack:
+        for item in all_buckets:
+            item = item_to_dict(item)
+            shard = get_shard(item)
+            if not shard:
+                log.error(f"[X] Unable to determine the shard for: {item['arn']}. Skipping.")
+                continue
+
+            if shard not in writers:
+                if commit:
+                    sink = stack.enter_context(S3StreamingUpload(prefix=get_shard_prefix(shard)))
+                else:
+                    sink = stack.enter_context(open(os.devnull, "wb"))
+
+                writers[shard] = ReportWriter(sink, generated_date=manifest["generated_date"])
+                writers[shard].start()
+
+            writers[shard].write_bucket(*serializer(item))
+
+        for writer in writers.values():
+            writer.finish()
+
+    if commit:
+        for shard, writer in writers.items():
+            add_shard(manifest, shard, writer.sink.etags, writer.bucket_count)
+
+        dump_manifest(manifest)
+
+
+def _out_of_time(context):
+    return context and context.get_remaining_time_in_millis() < CONFIG.checkpoint_margin
+
+
+def checkpoint_scan(state, context=None):
+    """
+    Scans the segments of the Current S3 table that are not yet complete (one after the other), and checkpoints the
+    serialized buckets every `CONFIG.checkpoint_items` items (see `historical_reports.s3.checkpoint`).
+
+    If the Lambda function has less than `CONFIG.checkpoint_margin` milliseconds left, then the progress is
+    checkpointed and the scan stops so that the next invocation can pick up from there.
+    :param state: The checkpoint state.
+    :param context: The Lambda context. If not supplied, then the scan runs to completion.
+    :return: Whether the scan is complete.
+    """
+    serializer = BucketSerializer()
+    total_segments = len(state["segments"])
+
+    for segment in range(total_segments):
+        progress = state["segments"][str(segment)]
+        if progress["complete"]:
+            continue
+
+        log.debug(f"[@] Scanning segment {segment + 1}/{total_segments} from: {progress['last_key'] or 'the start'}.")
+        last_key = progress["last_key"]
+        entries = {}
+        for item in _scan(segment=segment if total_segments > 1 else None,
+                          total_segments=total_segments if total_segments > 1 else None,
+                          last_evaluated_key=last_key):
+            name, details = serializer(item)
+            entries[name] = details
+            last_key = item.arn
+
+            if len(entries) >= CONFIG.checkpoint_items or _out_of_time(context):
+                save_checkpoint(state, segment, entries, last_key)
+                entries = {}
+
+                if _out_of_time(context):
+                    log.info(f"[!] Running out of time -- stopping at segment {segment + 1}/{total_segments}. "
+                             "The next invocation will resume from here.")
+                    return False
+
+        save_checkpoint(state, segment, entries, last_key, complete=True)
+
+    return True
+
+
+def dump_checkpointed_report(context=None):
+    """
+    Generates the report with the checkpointed scan (see `historical_reports.s3.checkpoint`). The scan resumes from the
+    staged checkpoint if there is one. Once the scan is complete, all of the staged parts are merged into the report.
+    :return: Whether the report was completed (or else, it needs to be resumed with another invocation).
+    """
+    state = load_state()
+    if state:
+        log.debug(f"[@] Resuming the checkpointed report from: {state['generated_date']}.")
+    else:
+        state = new_state(CONFIG.scan_segments)
+
+    if not checkpoint_scan(state, context=context):
+        return False
+
+    log.debug("[-->] The scan is complete. Merging the checkpointed parts and saving to S3.")
+    indexes = new_indexes()
+    with S3StreamingUpload() as upload:
+        writer = ReportWriter(upload, generated_date=state["generated_date"], indexes=indexes)
+        writer.start()
+        for name, details in iterate_parts(state):
+            writer.write_bucket(name, details)
+
+        writer.finish()
+
+    if not upload.unchanged:
+        dump_indexes(indexes, state["generated_date"], etags=upload.etags, skipped=upload.skipped)
+
+    delete_staging(state)
+
+    return True
+
+
+def _view_matches(view, item):
+    """Whether the item is included in the view -- it must match one of the values for each of the view's filters."""
+    for field, values in view.get("filters", {}).items():
+        if item.get(SHARD_FIELDS[field]) not in values:
+            return False
+
+    return True
+
+
+def dump_report_views(views, commit=True):
+    """
+    Generates all of the views of the report from a single scan of the table. Each view is streamed out to S3 as the
+    table is scanned. The views are dicts of:
+    ```
+    {
+        "prefix": "historical-s3-report-lite.json",  # Required
+        "buckets": ["some-bucket"],  # Optional -- defaults to `CONFIG.dump_to_buckets`
+        "exclude_fields": ["Name", "_version", "Grants"],  # Optional -- defaults to `CONFIG.exclude_fields`
+        "filters": {"AccountId": ["123456789012"], "Region": ["us-east-1"]}  # Optional -- only these buckets
+    }
+    ```
+    :param views: The list of the view definitions.
+    :param commit: Only saves the views to S3 if set.
+    """
+    for view in views:
+        if not view.get("prefix"):
+            raise ValueError(f"The report view: {view} is missing its prefix.")
+
+        for field in view.get("filters", {}):
+            if field not in SHARD_FIELDS:
+                raise ValueError(f"Unable to filter the report view by: {field}. "
+                                 f"Must be one of: {', '.join(SHARD_FIELDS)}.")
+
+    # Only the fields that every view excludes can be left out of the scan:
+    view_exclude_fields = [view.get("exclude_fields", CONFIG.exclude_fields) for view in views]
+    exclude_fields = set(view_exclude_fields[0]).intersection(*view_exclude_fields[1:]) if views else set()
+
+    with ExitStack() as stack:
+        writers = []
+        for view, fields in zip(views, view_exclude_fields):
+            if commit:
+                sink = stack.enter_context(S3StreamingUpload(buckets=view.get("buckets"), prefix=view["prefix"]))
+            else:
+                sink = stack.enter_context(open(os.devnull, "wb"))
+
+            writers.append((view, BucketSerializer(exclude_fields=fields), ReportWriter(sink)))
+            writers[-1][2].start()
+
+        for item in scan_buckets(exclude_fields=exclude_fields):
+            item = item_to_dict(item)
+            for view, serializer, writer in writers:
+                if _view_matches(view, item):
+                    writer.write_bucket(*serializer(item))
+
+        for _, _, writer in writers:
+            writer.finish()
+
+    log.debug(f"[+] Saved the report views: {', '.join(view['prefix'] for view in views)}.")
+
+
+def dump_report(commit=True, context=None, views=None):
+    """
+    Generates the full report.
+    :param commit: Only saves the report to S3 if set.
+    :param context: The Lambda context -- used by the checkpointed report to know when it is running out of time.
+    :param views: Optional list of report view definitions to generate from the single scan instead (see
+                  `dump_report_views`). Defaults to `CONFIG.report_views`.
+    """
+    views = views if views is not None else CONFIG.report_views
+    if views:
+        log.debug(f"[@] Starting... Generating {len(views)} report views.")
+        dump_report_views(views, commit=commit)
+        log.debug("[@] Completed S3 report generation.")
+        return
+
+    if CONFIG.checkpoint and CONFIG.shard_by:
+        log.warning("[!] Checkpointing is not supported for the sharded report. Generating it in a single scan.")
+
+    elif CONFIG.checkpoint and commit:
+        log.debug("[@] Starting the checkpointed report.")
+        if dump_checkpointed_report(context=context):
+            log.debug("[@] Completed S3 report generation.")
+
+        return
 
-def dump_report(commit=True):
     # Get all the data from DynamoDB:
     log.debug("[@] Starting... Beginning scan.")
-    all_buckets = CurrentS3Model.scan()
+    save_report(scan_buckets(), commit=commit)
 
-    generated_file = S3ReportSchema(strict=True).dump({"all_buckets": all_buckets}).data
+    log.debug("[@] Completed S3 report generation.")
 
-    # Dump to S3:
-    if commit:
+
+def save_report(all_buckets, commit=True):
+    """
+    Streams the report out to S3 as the items come in (either as a single report, or sharded).
+    :param all_buckets: Iterable of Current S3 table items (PynamoDB objects or dicts).
+    :param commit: Only saves the report to S3 if set.
+    """
+    if CONFIG.shard_by:
+        log.debug(f"[-->] Saving the report sharded by: {', '.join(CONFIG.shard_by)}.")
+        dump_sharded_report(all_buckets, commit=commit)
+
+    elif commit:
         log.debug("[-->] Saving to S3.")
+        indexes = new_indexes()
+        with S3StreamingUpload() as upload:
+            writer = write_report(upload, all_buckets, indexes=indexes)
+
+        if not upload.unchanged:
+            dump_indexes(indexes, writer.generated_date, etags=upload.etags, skipped=upload.skipped)
 
-        # Replace <empty> with "" <-- Due to Pynamo/Dynamo issues...
-        dump_to_s3(json.dumps(generated_file, indent=4).replace("\"<empty>\"", "\"\"").encode("utf-8"))
     else:
         log.debug("[/] Commit flag not set, not saving.")
-
-    log.debug("[@] Completed S3 report generation.")
+        with open(os.devnull, "wb") as sink:
+            write_report(sink, all_buckets)
@@ -0,0 +1,123 @@
+"""
+.. module: historical_reports.s3.indexes
+    :platform: Unix
+    :copyright: (c) 2017 by Netflix Inc., see AUTHORS for more
+    :license: Apache, see LICENSE for more details.
+.. author:: Mike Grima <mgrima@netflix.com>
+
+Secondary index objects of the report. When `CONFIG.indexes` is set, small index objects that map the account IDs,
+regions, and tag keys/values to the names of the buckets are saved alongside the report:
+```
+historical-s3-report/indexes/account.json  -- {"index": {"123456789012": ["bucket", ...]}, ...}
+historical-s3-report/indexes/region.json   -- {"index": {"us-east-1": ["bucket", ...]}, ...}
+historical-s3-report/indexes/tag.json      -- {"index": {"tag key": {"tag value": ["bucket", ...]}}, ...}
+```
+The indexes are built from the report entries as the report is written out (by the `ReportWriter`), so they are
+re-built with every full report and every update. Fields that are excluded from the report are not indexed.
+(Indexes are not made for the sharded report layout.)
+
+When `CONFIG.offset_index` is set, the byte offset and length of each bucket's entry within the report is also saved:
+```
+historical-s3-report/indexes/offsets.json  -- {"etags": {"dump bucket": "report ETag"}, "buckets": {"bucket": [0, 10]}}
+```
+With this, a single bucket's entry can be fetched with a `Range` GET of the report (see `util.fetch_bucket_entry`)
+instead of downloading the whole report. The ETags are of the report that the offsets are for. The offsets are of the
+uncompressed report, so this index is not saved if `CONFIG.compression` is set.
+"""
+import logging
+from collections import defaultdict
+
+from historical.constants import LOGGING_LEVEL
+
+from historical_reports.s3.compression import get_encoding
+from historical_reports.s3.config import CONFIG
+from historical_reports.s3.json_backend import dumps
+from historical_reports.s3.util import dump_to_s3, get_sibling_prefix
+
+logging.basicConfig()
+log = logging.getLogger('historical-reports-s3')
+log.setLevel(LOGGING_LEVEL)
+
+
+def get_index_prefix(index, prefix=None):
+    """Returns the S3 prefix of the index, which lives under the report prefix (without the extension)."""
+    return get_sibling_prefix(f"indexes/{index}", prefix)
+
+
+class ReportIndexes:
+    """Builds up the secondary indexes and/or the byte offsets of the report, one bucket entry at a time."""
+    def __init__(self, secondary=True, offsets=False):
+        self.secondary = secondary
+        self.accounts = defaultdict(set)
+        self.regions = defaultdict(set)
+        self.tags = defaultdict(lambda: defaultdict(set))
+        self.offsets = {} if offsets else None
+
+    def add(self, name, details, offset=None, length=None):
+        if self.offsets is not None and offset is not None:
+            self.offsets[name] = [offset, length]
+
+        if not self.secondary:
+            return
+
+        if details.get("AccountId"):
+            self.accounts[details["AccountId"]].add(name)
+
+        if details.get("Region"):
+            self.regions[details["Region"]].add(name)
+
+        for key, value in (details.get("Tags") or {}).items():
+            self.tags[key][value].add(name)
+
+    def serialize(self):
+        """Returns the dict of the index names to the secondary indexes (with the bucket names sorted)."""
+        if not self.secondary:
+            return {}
+
+        return {
+            "account": {account: sorted(names) for account, names in self.accounts.items()},
+            "region": {region: sorted(names) for region, names in self.regions.items()},
+            "tag": {key: {value: sorted(names) for value, names in values.items()} for key, values in self.tags.items()}
+        }
+
+
+def new_indexes():
+    """Returns the `ReportIndexes` to build -- or None if neither `CONFIG.indexes` nor `CONFIG.offset_index` is set."""
+    offsets = bool(CONFIG.offset_index)
+    if offsets and get_encoding():
+        log.warning("[!] The offset index is not made for compressed reports. Skipping it.")
+        offsets = False
+
+    if not CONFIG.indexes and not offsets:
+        return None
+
+    return ReportIndexes(secondary=bool(CONFIG.indexes), offsets=offsets)
+
+
+def dump_indexes(indexes, generated_date, prefix=None, etags=None, skipped=None):
+    """
+    Saves all of the index objects to S3.
+    :param indexes: The `ReportIndexes` (does nothing if None).
+    :param generated_date: The `generated_date` of the report that the indexes are for.
+    :param prefix: The prefix of the report. Defaults to `CONFIG.dump_to_prefix`.
+    :param etags: The `{bucket: ETag}` of the saved report (from the `S3StreamingUpload`) -- for the offset index.
+    :param skipped: The buckets that the report was not uploaded to, as they already had the same content (see
+                    `S3StreamingUpload.skipped`). The offset index is not saved if there are any: the kept report may
+                    have its buckets in a different order, so the offsets would not line up with its ETag.
+    """
+    if indexes is None:
+        return
+
+    for index, values in indexes.serialize().items():
+        log.debug(f"[-->] Saving the {index} index to S3.")
+        document = {"s3_report_version": CONFIG.s3_reports_version, "generated_date": generated_date, "index": values}
+        dump_to_s3(dumps(document).encode("utf-8"), prefix=get_index_prefix(index, prefix))
+
+    if indexes.offsets is not None and skipped:
+        log.debug("[/] The report was not uploaded to: {} -- not saving the offset index.".format(", ".join(skipped)))
+
+    elif indexes.offsets is not None:
+        log.debug("[-->] Saving the offset index to S3.")
+        document = {"s3_report_version": CONFIG.s3_reports_version, "generated_date": generated_date,
+                    "etags": etags or {}, "buckets": indexes.offsets}
+        dump_to_s3(dumps(document).encode("utf-8"), prefix=get_index_prefix("offsets", prefix))
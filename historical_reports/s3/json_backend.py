@@ -0,0 +1,95 @@
+"""
+.. module: historical_reports.s3.json_backend
+    :platform: Unix
+    :copyright: (c) 2017 by Netflix Inc., see AUTHORS for more
+    :license: Apache, see LICENSE for more details.
+.. author:: Mike Grima <mgrima@netflix.com>
+
+The JSON encoder/decoder for the reports. `CONFIG.json_backend` picks the library that is used:
+- `auto` (the default) -- `orjson` if installed, then `ujson` if installed, and then the stdlib `json`.
+- `orjson`, `ujson` or `json` to force a specific library.
+
+The indented report is always encoded with the stdlib `json` so that it is unchanged from what the `S3ReportSchema`
+produces (neither `orjson` nor `ujson` can produce the same 4 space indentation). The faster libraries are used for the
+compact report (`CONFIG.compact_report`) and for decoding.
+"""
+import json
+
+from historical.attributes import decimal_default, fix_decimals
+
+from historical_reports.s3.config import CONFIG
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import ujson
+except ImportError:
+    ujson = None
+
+INDENT = 4
+
+
+def _json_dumps(obj):
+    return json.dumps(obj, separators=(",", ":"), default=decimal_default)
+
+
+def _orjson_dumps(obj):
+    return orjson.dumps(obj, default=decimal_default).decode("utf-8")
+
+
+def _ujson_dumps(obj):
+    # ujson encodes Decimals as floats (1 becomes 1.0) without calling a default function, so they need to be
+    # converted first. NOTE: This converts them in place.
+    return ujson.dumps(fix_decimals(obj), ensure_ascii=False, escape_forward_slashes=False)
+
+
+# In order of preference:
+BACKENDS = {
+    "orjson": (orjson, _orjson_dumps, lambda data: orjson.loads(data)),
+    "ujson": (ujson, _ujson_dumps, lambda data: ujson.loads(data)),
+    "json": (json, _json_dumps, json.loads)
+}
+
+
+def get_backend(name=None):
+    """
+    Returns the name of the JSON library to use.
+    :param name: Defaults to `CONFIG.json_backend`.
+    """
+    name = name or CONFIG.json_backend
+    if name == "auto":
+        return next(backend for backend, (module, _, _) in BACKENDS.items() if module)
+
+    if name not in BACKENDS:
+        raise ValueError(f"Unknown JSON backend: {name}. Must be one of: auto, {', '.join(BACKENDS)}.")
+
+    if not BACKENDS[name][0]:
+        raise ValueError(f"The JSON backend: {name} is not installed.")
+
+    return name
+
+
+def dumps(obj, compact=None, backend=None):
+    """
+    Encodes the object into JSON text. Decimals are encoded the same way as `historical.attributes.decimal_default`.
+    :param compact: Encode without any indentation or whitespace. Defaults to `CONFIG.compact_report`.
+    :param backend: Overrides `CONFIG.json_backend` if supplied.
+    """
+    if compact is None:
+        compact = CONFIG.compact_report
+
+    if not compact:
+        return json.dumps(obj, indent=INDENT, default=decimal_default)
+
+    return BACKENDS[get_backend(backend)][1](obj)
+
+
+def loads(data, backend=None):
+    """
+    Decodes the JSON text (str or bytes).
+    :param backend: Overrides `CONFIG.json_backend` if supplied.
+    """
+    return BACKENDS[get_backend(backend)][2](data)
@@ -36,19 +36,29 @@ def _serialize_bucket(bucket, account_id, region, tags):
     return bucket
 
 
+def serialize_item(item):
+    """
+    Serializes a Current S3 table item into the bucket name and its report entry.
+    :param item: Either a PynamoDB `CurrentS3Model` object, or the `dict` of one.
+    :return: A tuple of the bucket name and the bucket's report entry.
+    """
+    # This function is called whether the buckets are dicts or PynamoDB objects, so always convert to a dict
+    # to make this universal:
+    bucket = dict(item)
+
+    log.debug(f"[+] Fetched details for bucket: {bucket['arn']}")
+
+    return bucket['BucketName'], _serialize_bucket(bucket['configuration'], bucket['accountId'], bucket['Region'],
+                                                   bucket['Tags'])
+
+
 class BucketField(Field):
     def _serialize(self, value, attr=None, data=None):
         buckets = data.get("buckets", {})
         for b in data["all_buckets"]:
-            # This function is called whether the buckets are dicts or PynamoDB objects, so always convert to a dict
-            # to make this universal:
-            bucket = dict(b)
-
-            log.debug(f"[+] Fetched details for bucket: {bucket['arn']}")
-
             # Add the bucket:
-            buckets[bucket['BucketName']] = _serialize_bucket(bucket['configuration'], bucket['accountId'],
-                                                              bucket['Region'], bucket['Tags'])
+            name, details = serialize_item(b)
+            buckets[name] = details
 
         return buckets
 
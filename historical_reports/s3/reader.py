@@ -0,0 +1,136 @@
+"""
+.. module: historical_reports.s3.reader
+    :platform: Unix
+    :copyright: (c) 2017 by Netflix Inc., see AUTHORS for more
+    :license: Apache, see LICENSE for more details.
+.. author:: Mike Grima <mgrima@netflix.com>
+
+Incremental reader of the report JSON. The bucket entries are yielded one at a time as the report is read from a
+binary stream (like the S3 object body), so the whole report is never held in memory -- neither as bytes, as text, nor
+as objects. If the `ijson` library is installed, then it is used for the parsing. Otherwise, the entries are parsed
+out of a small, rolling text buffer with the standard library's `JSONDecoder.raw_decode`.
+"""
+import codecs
+import json
+import re
+
+try:
+    import ijson
+except ImportError:
+    ijson = None
+
+# The number of bytes that are read from the stream at a time:
+READ_CHUNK_SIZE = 64 * 1024
+
+_WHITESPACE = re.compile(r"\s*")
+_NUMBER_CHARACTERS = frozenset("0123456789.eE+-")
+_DECODER = json.JSONDecoder()
+
+
+class _TextBuffer:
+    """Rolling buffer of the text of the stream. Only the text that has not been parsed yet is kept around."""
+    def __init__(self, stream, chunk_size=None):
+        self.stream = stream
+        self.chunk_size = chunk_size or READ_CHUNK_SIZE
+        self.text = ""
+        self.position = 0
+        self._decoder = codecs.getincrementaldecoder("utf-8")()
+        self._eof = False
+
+    def fill(self):
+        """Reads more of the stream into the buffer. Returns False if the stream has already been read to the end."""
+        if self._eof:
+            return False
+
+        chunk = self.stream.read(self.chunk_size)
+        self._eof = not chunk
+        self.text = self.text[self.position:] + self._decoder.decode(chunk, final=self._eof)
+        self.position = 0
+
+        return True
+
+    def peek(self):
+        """Skips over any whitespace, and returns the next character (or an empty string at the end)."""
+        while True:
+            self.position = _WHITESPACE.match(self.text, self.position).end()
+            if self.position < len(self.text) or not self.fill():
+                return self.text[self.position:self.position + 1]
+
+    def expect(self, characters):
+        character = self.peek()
+        if not character or character not in characters:
+            raise ValueError(f"Invalid report JSON: expected one of: {characters} at: {character or 'the end'}.")
+
+        self.position += 1
+        return character
+
+    def value(self):
+        """Decodes the next JSON value -- reading in more of the stream until the whole value is buffered."""
+        self.peek()
+        while True:
+            try:
+                value, end = _DECODER.raw_decode(self.text, self.position)
+
+                # A number at the end of the buffer (or that stops short at a `.`, `e`, or sign) may continue on in
+                # the next chunk:
+                truncated = end == len(self.text) or \
+                    (isinstance(value, (int, float)) and self.text[end] in _NUMBER_CHARACTERS)
+                if not truncated or self._eof:
+                    self.position = end
+                    return value
+
+            except json.JSONDecodeError:
+                if self._eof:
+                    raise
+
+            self.fill()
+
+
+def _iterate_object(buffer):
+    """Yields the members of the JSON object that starts at the buffer's position."""
+    buffer.expect("{")
+    if buffer.peek() == "}":
+        buffer.expect("}")
+        return
+
+    while True:
+        key = buffer.value()
+        buffer.expect(":")
+        yield key
+
+        if buffer.expect(",}") == "}":
+            return
+
+
+def _iterate_buckets(stream):
+    buffer = _TextBuffer(stream)
+    members = _iterate_object(buffer)
+    for key in members:
+        if key != "buckets":
+            # The value of the member is consumed before moving on to the next member:
+            buffer.value()
+            continue
+
+        for name in _iterate_object(buffer):
+            yield name, buffer.value()
+
+
+def _iterate_ijson_buckets(stream):
+    try:
+        yield from ijson.kvitems(stream, "buckets", use_float=True)
+
+    except ijson.JSONError as e:
+        raise ValueError(f"Invalid report JSON: {e}") from e
+
+
+def iterate_report_buckets(stream):
+    """
+    Reads the bucket entries out of the report as they are streamed in.
+    :param stream: Binary, file-like object of the report JSON (with a `read(size)`).
+    :return: An iterable of the bucket names and their report entries (in the order that they are in the report).
+             A `ValueError` is raised if the report is not valid JSON.
+    """
+    if ijson:
+        return _iterate_ijson_buckets(stream)
+
+    return _iterate_buckets(stream)
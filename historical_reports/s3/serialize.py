@@ -0,0 +1,323 @@
+"""
+.. module: historical_reports.s3.serialize
+    :platform: Unix
+    :copyright: (c) 2017 by Netflix Inc., see AUTHORS for more
+    :license: Apache, see LICENSE for more details.
+.. author:: Mike Grima <mgrima@netflix.com>
+"""
+import hashlib
+import json
+import logging
+from decimal import Decimal
+
+from historical.attributes import HistoricalDecimalAttribute
+from historical.constants import LOGGING_LEVEL
+from pynamodb.attributes import MapAttribute, NumberAttribute
+
+from historical_reports.s3.config import CONFIG
+from historical_reports.s3.json_backend import dumps, INDENT
+from historical_reports.s3.models import get_generated_time
+from historical_reports.s3.util import S3StreamingUpload
+
+logging.basicConfig()
+log = logging.getLogger('historical-reports-s3')
+log.setLevel(LOGGING_LEVEL)
+
+# The only Current S3 table item attributes that are needed to serialize the report:
+ITEM_ATTRIBUTES = ("arn", "BucketName", "accountId", "Region", "Tags", "configuration")
+
+# The report fields that come straight from a top-level Current S3 table item attribute. If these are excluded from
+# the report, then the attribute does not need to be fetched at all:
+EXCLUDABLE_ATTRIBUTES = {"Tags": "Tags"}
+
+# PynamoDB/DynamoDB can't store empty strings, so they come out of the table as this placeholder:
+EMPTY_PLACEHOLDER = "<empty>"
+
+
+def get_projection(extra_attributes=(), exclude_fields=None):
+    """
+    Returns the Current S3 table item attributes to fetch for the report (the DynamoDB `ProjectionExpression`).
+
+    This is the `ITEM_ATTRIBUTES` -- less any that are entirely excluded from the report. The excluded fields within
+    the `configuration` can't be pushed down, as the projection can only select the fields to include.
+    :param extra_attributes: Any other attributes that are needed.
+    :param exclude_fields: Defaults to `CONFIG.exclude_fields`.
+    """
+    exclude_fields = CONFIG.exclude_fields if exclude_fields is None else exclude_fields
+    excluded = {EXCLUDABLE_ATTRIBUTES[field] for field in exclude_fields if field in EXCLUDABLE_ATTRIBUTES}
+
+    return [attribute for attribute in ITEM_ATTRIBUTES + tuple(extra_attributes) if attribute not in excluded]
+
+
+def item_to_dict(item, attributes=ITEM_ATTRIBUTES):
+    """
+    Converts a Current S3 table item to a dict -- the same as `dict(item)` would, but only for the supplied attributes.
+    (`dict(item)` also converts the large `userIdentity`, `requestParameters`, etc. fields that are never used, and it
+    can't convert items that were fetched with a projection.) Attributes that were not fetched are None.
+
+    NOTE: Unlike `dict(item)`, the Decimals are left in place. They are removed by `clean_values` when serialized.
+    :param item: Either a PynamoDB `CurrentS3Model` object, or the `dict` of one (which is returned as-is).
+    :param attributes: Defaults to the `ITEM_ATTRIBUTES`.
+    """
+    if isinstance(item, dict):
+        return item
+
+    item_attributes = item.get_attributes()
+    values = {}
+    for name in attributes:
+        attr = item_attributes[name]
+        value = getattr(item, name, None)
+
+        if value is None:
+            values[name] = None
+        elif isinstance(attr, MapAttribute):
+            values[name] = value.as_dict()
+        elif isinstance(attr, (NumberAttribute, HistoricalDecimalAttribute)):
+            values[name] = int(attr.serialize(value))
+        else:
+            values[name] = attr.serialize(value)
+
+    return values
+
+
+def clean_values(obj):
+    """
+    Returns a copy of the object with the Decimals removed (like `historical.attributes.fix_decimals`) and with the
+    `<empty>` placeholders (as keys or values) replaced with "" -- all in one pass.
+    """
+    if isinstance(obj, dict):
+        return {("" if key == EMPTY_PLACEHOLDER else key): clean_values(value) for key, value in obj.items()}
+
+    if isinstance(obj, list):
+        return [clean_values(value) for value in obj]
+
+    if isinstance(obj, Decimal):
+        return int(obj) if obj % 1 == 0 else float(obj)
+
+    if obj == EMPTY_PLACEHOLDER:
+        return ""
+
+    return obj
+
+
+class BucketSerializer:
+    """
+    Fast path replacement for `serialize_item` (and thus the `BucketField`) when generating the report.
+
+    The output is identical to the `S3ReportSchema` -- but the exclusion set is only computed once, only the needed
+    item attributes are converted, and nothing is formatted for the per-bucket debug logging unless it's enabled.
+    The `<empty>` placeholders are also replaced as the entry is built, so the JSON text never needs to be fixed up
+    afterwards. The items are not modified.
+    """
+    def __init__(self, exclude_fields=None):
+        self.exclude_fields = frozenset(CONFIG.exclude_fields if exclude_fields is None else exclude_fields)
+        self._debug = log.isEnabledFor(logging.DEBUG)
+
+    def __call__(self, item):
+        """
+        Serializes a Current S3 table item into the bucket name and its report entry.
+        :param item: Either a PynamoDB `CurrentS3Model` object, or the `dict` of one.
+        :return: A tuple of the bucket name and the bucket's report entry.
+        """
+        item = item_to_dict(item)
+
+        if self._debug:
+            log.debug(f"[+] Fetched details for bucket: {item['arn']}")
+
+        details = clean_values(item['configuration'])
+        details['AccountId'] = clean_values(item['accountId'])
+        details['Region'] = clean_values(item['Region'])
+        details['Tags'] = clean_values(item['Tags'])
+
+        # Remove fields in the exclusion list:
+        for field in self.exclude_fields.intersection(details):
+            del details[field]
+
+        return clean_values(item['BucketName']), details
+
+
+class FragmentCache:
+    """
+    Cache of the encoded (JSON bytes) report entries, keyed by the bucket name and the version of the entry's content.
+
+    This is kept with the report in the warm container cache, so that each update only re-encodes the entries that
+    changed -- the rest of the entries are written out as the cached bytes. The entries are never modified in place (a
+    changed entry is a new dict), so the version of the content is the entry object itself. The cache holds on to the
+    entry, so its identity can't be reused by another object. The fragments are rebuilt with every report that is
+    written, so entries for buckets that are no longer in the report are dropped.
+    """
+    def __init__(self):
+        self.layout = None
+        self._fragments = {}
+        self._next = {}
+
+    def start(self, layout):
+        """Starts a new report. The fragments are thrown out if the layout (indentation or JSON backend) changed."""
+        if layout != self.layout:
+            self.layout = layout
+            self._fragments = {}
+
+        self._next = {}
+
+    def get(self, name, details):
+        fragment = self._fragments.get(name)
+        if fragment and fragment[0] is details:
+            self._next[name] = fragment
+            return fragment[1]
+
+        return None
+
+    def put(self, name, details, data):
+        self._next[name] = (details, data)
+
+    def finish(self):
+        self._fragments, self._next = self._next, {}
+
+    def __len__(self):
+        return len(self._fragments)
+
+
+class ReportWriter:
+    """
+    Incrementally writes out the S3 report JSON to a binary, file-like sink -- one bucket at a time.
+
+    The output is the same as `json.dumps(S3ReportSchema().dump(...).data, indent=4)` (with the top-level fields in a
+    fixed order, and with the `<empty>` placeholders replaced), but only one bucket entry is ever held as text in memory
+    at a time. The bucket entries must already be cleaned up (see `BucketSerializer`). If `compact` is set (defaults to
+    `CONFIG.compact_report`), then the report is written out without any indentation or whitespace with the configured
+    JSON backend (see `historical_reports.s3.json_backend`).
+
+    If `indexes` (a `historical_reports.s3.indexes.ReportIndexes`) is supplied, then each bucket that is written out is
+    also added to the indexes -- along with the byte offset and length of its entry within the (uncompressed) report.
+
+    If `CONFIG.skip_unchanged` is set, then a SHA-256 `content_hash` is made of the report version, the layout, and the
+    sorted names and hashes of the bucket entries (that is, everything but the `generated_date` -- and regardless of the
+    order that the buckets were written in). If the sink is an `S3StreamingUpload`, then the hash is handed to it, so
+    that it can skip the upload if the report in S3 has the same content.
+
+    If `fragments` (a `FragmentCache`) is supplied, then the encoded entries are reused from (and saved to) it.
+    """
+    def __init__(self, sink, generated_date=None, compact=None, indexes=None, fragments=None):
+        self.sink = sink
+        self.generated_date = generated_date or get_generated_time()
+        self.compact = CONFIG.compact_report if compact is None else compact
+        self.indexes = indexes
+        self.fragments = fragments
+        self.bucket_count = 0
+        self.offset = 0  # The number of bytes that were written out so far
+        self.content_hash = None
+        self._written = set()
+        self._entry_hashes = [] if CONFIG.skip_unchanged else None
+
+    def _write(self, text):
+        self._write_bytes(text.encode("utf-8"))
+
+    def _write_bytes(self, data):
+        self.sink.write(data)
+        self.offset += len(data)
+
+    def start(self):
+        if self.fragments is not None:
+            self.fragments.start((self.compact, CONFIG.json_backend))
+
+        if self.compact:
+            self._write(f"{{\"s3_report_version\":{json.dumps(CONFIG.s3_reports_version)},"
+                        f"\"generated_date\":{json.dumps(self.generated_date)},\"buckets\":{{")
+            return
+
+        self._write("{\n" + " " * INDENT + f"\"s3_report_version\": {json.dumps(CONFIG.s3_reports_version)},\n"
+                    + " " * INDENT + f"\"generated_date\": {json.dumps(self.generated_date)},\n"
+                    + " " * INDENT + "\"buckets\": {")
+
+    def write_bucket(self, name, details):
+        # Buckets can only appear once in the report:
+        if name in self._written:
+            log.debug(f"[/] Bucket: {name} has already been written to the report. Skipping.")
+            return
+
+        self._written.add(name)
+        data = self.fragments.get(name, details) if self.fragments is not None else None
+        if data is None:
+            data = self._encode(name, details)
+            if self.fragments is not None:
+                self.fragments.put(name, details, data)
+
+        if self.compact:
+            separator = "," if self.bucket_count else ""
+        else:
+            separator = ",\n" if self.bucket_count else "\n"
+
+        self.bucket_count += 1
+
+        self._write(separator)
+        if self.indexes is not None:
+            self.indexes.add(name, details, offset=self.offset, length=len(data))
+
+        self._write_bytes(data)
+        if self._entry_hashes is not None:
+            self._entry_hashes.append((name, hashlib.sha256(data).digest()))
+
+    def _encode(self, name, details):
+        if self.compact:
+            return dumps({name: details}, compact=True)[1:-1].encode("utf-8")
+
+        # The entries are nested 2 levels deep within the report:
+        entry = dumps({name: details}, compact=False)[2:-2]
+        return (" " * INDENT + entry.replace("\n", "\n" + " " * INDENT)).encode("utf-8")
+
+    def finish(self):
+        if self.compact:
+            self._write("}}")
+        elif self.bucket_count:
+            self._write("\n" + " " * INDENT + "}\n}")
+        else:
+            self._write("}\n}")
+
+        if self.fragments is not None:
+            self.fragments.finish()
+
+        if self._entry_hashes is not None:
+            # The layout of the report is a part of its content:
+            content_hash = hashlib.sha256(str(CONFIG.s3_reports_version).encode("utf-8"))
+            content_hash.update(b"compact" if self.compact else b"indented")
+            for name, entry_hash in sorted(self._entry_hashes):
+                content_hash.update(name.encode("utf-8") + b"\0" + entry_hash)
+
+            self.content_hash = content_hash.hexdigest()
+            if isinstance(self.sink, S3StreamingUpload):
+                self.sink.content_hash = self.content_hash
+
+
+def write_report(sink, all_buckets, buckets=None, generated_date=None, indexes=None, fragments=None):
+    """
+    Streams out the full S3 report to the sink.
+
+    This follows the same logic as the `S3ReportSchema`: the serialized `all_buckets` items are either updated in place
+    within the existing `buckets` entries (if any) or appended to them.
+    :param sink: Binary, file-like object to write the report to.
+    :param all_buckets: Iterable of Current S3 table items (PynamoDB objects or dicts) to serialize.
+    :param buckets: Optional dict of already serialized bucket entries (from an existing report). This is updated with
+                    the serialized `all_buckets` items.
+    :param generated_date: Optional override for the report's `generated_date`.
+    :param indexes: Optional `ReportIndexes` to add the buckets to.
+    :param fragments: Optional `FragmentCache` of the encoded entries.
+    :return: The `ReportWriter` that wrote the report.
+    """
+    writer = ReportWriter(sink, generated_date=generated_date, indexes=indexes, fragments=fragments)
+    writer.start()
+
+    serializer = BucketSerializer()
+    if buckets is not None:
+        # The updated items are only a small subset of the report, so these can be serialized up front:
+        buckets.update(serializer(item) for item in all_buckets)
+        all_buckets = buckets.items()
+
+    else:
+        all_buckets = (serializer(item) for item in all_buckets)
+
+    for name, details in all_buckets:
+        writer.write_bucket(name, details)
+
+    writer.finish()
+
+    return writer
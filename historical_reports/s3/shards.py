@@ -0,0 +1,101 @@
+"""
+.. module: historical_reports.s3.shards
+    :platform: Unix
+    :copyright: (c) 2017 by Netflix Inc., see AUTHORS for more
+    :license: Apache, see LICENSE for more details.
+.. author:: Mike Grima <mgrima@netflix.com>
+
+Helpers for the sharded report layout. When `CONFIG.shard_by` is set, the report is split up into one report per
+shard (for example, per account or per account and region), and a small manifest lists out all of the shards:
+```
+historical-s3-report/manifest.json
+historical-s3-report/123456789012/us-east-1.json
+...
+```
+Each shard is a normal S3 report that contains only the buckets for that shard.
+"""
+import logging
+
+from historical.constants import LOGGING_LEVEL
+
+from historical_reports.s3.config import CONFIG
+from historical_reports.s3.json_backend import dumps, loads
+from historical_reports.s3.models import get_generated_time
+from historical_reports.s3.util import dump_to_s3, fetch_from_s3, get_sibling_prefix
+
+logging.basicConfig()
+log = logging.getLogger('historical-reports-s3')
+log.setLevel(LOGGING_LEVEL)
+
+# The report fields that the report can be sharded by, and the Current S3 table item attributes that they come from:
+SHARD_FIELDS = {
+    "AccountId": "accountId",
+    "Region": "Region"
+}
+
+
+def get_shard(item, shard_by=None):
+    """
+    Determines the shard that a Current S3 table item belongs in.
+    :param item: The `dict` of the Current S3 table item.
+    :param shard_by: Defaults to `CONFIG.shard_by`.
+    :return: The shard ID, (like "123456789012/us-east-1") or None if it can't be determined from the item.
+    """
+    values = []
+    for field in shard_by or CONFIG.shard_by:
+        if field not in SHARD_FIELDS:
+            raise ValueError(f"Unable to shard the report by: {field}. Must be one of: {', '.join(SHARD_FIELDS)}.")
+
+        value = item.get(SHARD_FIELDS[field])
+        if not value:
+            return None
+
+        values.append(value)
+
+    return "/".join(values)
+
+
+def get_shard_prefix(shard, prefix=None):
+    """Returns the S3 prefix of the shard, which lives under the report prefix (without the extension)."""
+    return get_sibling_prefix(shard, prefix)
+
+
+def get_manifest_prefix(prefix=None):
+    """Returns the S3 prefix of the manifest, which lives under the report prefix (without the extension)."""
+    return get_sibling_prefix("manifest", prefix)
+
+
+def new_manifest(generated_date=None):
+    return {
+        "s3_report_version": CONFIG.s3_reports_version,
+        "generated_date": generated_date or get_generated_time(),
+        "shard_by": CONFIG.shard_by,
+        "shards": {}
+    }
+
+
+def add_shard(manifest, shard, etags, bucket_count):
+    """Records the shard that was just saved (along with its ETag) in the manifest."""
+    if not bucket_count:
+        manifest["shards"].pop(shard, None)
+        return
+
+    manifest["shards"][shard] = {
+        "prefix": get_shard_prefix(shard),
+        "etag": etags.get(CONFIG.dump_to_buckets[0]),
+        "bucket_count": bucket_count
+    }
+
+
+def fetch_manifest():
+    """Fetches the manifest of the sharded report from the import location. Returns None if it does not exist."""
+    existing_json, _ = fetch_from_s3(prefix=get_manifest_prefix(CONFIG.import_prefix))
+    if not existing_json:
+        return None
+
+    return loads(existing_json)
+
+
+def dump_manifest(manifest):
+    log.debug("[-->] Saving the manifest to S3.")
+    return dump_to_s3(dumps(manifest).encode("utf-8"), prefix=get_manifest_prefix())
@@ -5,19 +5,49 @@
     :license: Apache, see LICENSE for more details.
 .. author:: Mike Grima <mgrima@netflix.com>
 """
+import gzip
+import io
 import json
+import os
+import threading
+import zlib
+from datetime import datetime, timedelta
+from decimal import Decimal
 
 import pytest
+from botocore.exceptions import ClientError, EndpointConnectionError
+from click.testing import CliRunner
+from botocore.stub import Stubber
 from historical.common.util import deserialize_records
 from historical.constants import EVENT_TOO_BIG_FLAG
 from historical.s3.models import CurrentS3Model
-
+from pynamodb.connection.base import Connection
+from pynamodb.exceptions import GetError, ScanError
+
+import historical_reports.s3.distributed
+import historical_reports.s3.generate
+import historical_reports.s3.indexes
+import historical_reports.s3.reader
+import historical_reports.s3.update
+import historical_reports.s3.util
+from historical_reports.s3.cli import cli
 from historical_reports.s3.entrypoints import handler
+from historical_reports.s3.checkpoint import delete_staged, list_staged, load_state
+from historical_reports.s3.compression import ENCODINGS, compress, decompress, get_encoding, zstandard
 from historical_reports.s3.config import CONFIG
+from historical_reports.s3.deltas import compact_deltas, fold_delta, list_deltas
+from historical_reports.s3.distributed import LocalInvoker, get_segments_prefix, reduce, scan_segment
 from historical_reports.s3.generate import dump_report
+from historical_reports.s3.indexes import dump_indexes, get_index_prefix, ReportIndexes
+from historical_reports.s3.json_backend import BACKENDS, dumps, loads, get_backend
 from historical_reports.s3.models import S3ReportSchema
-from historical_reports.s3.update import process_durable_event, update_records
-from historical_reports.s3.util import dump_to_s3, set_config_from_input
+from historical_reports.s3.reader import iterate_report_buckets
+from historical_reports.s3.serialize import write_report, BucketSerializer, ReportWriter
+from historical_reports.s3.update import _fetch_current_item, process_durable_event, update_records, \
+    fetch_too_big_items, coalesce_records, _REPORT_CACHE
+from historical_reports.s3.util import dump_to_s3, set_config_from_input, S3StreamingUpload, ReportUploadError, \
+    get_s3_client, get_bucket_region, get_bucket_client, _get_from_s3, NOT_MODIFIED, fetch_from_s3, \
+    fetch_bucket_entry, get_sibling_prefix, CONTENT_HASH_METADATA
 
 
 class MockContext:
@@ -25,6 +55,16 @@ class MockContext:
         return 9000
 
 
+class ExpiringContext:
+    """Runs out of time after the remaining time has been checked the supplied number of times."""
+    def __init__(self, checks):
+        self.checks = checks
+
+    def get_remaining_time_in_millis(self):
+        self.checks -= 1
+        return 9000 if self.checks >= 0 else 0
+
+
 def test_historical_table_fixture(historical_table):
     assert CurrentS3Model.count() == 10
 
@@ -98,6 +138,436 @@ def test_dump_to_s3(dump_buckets, generated_file):
     CONFIG.dump_to_buckets = old_value
 
 
+@pytest.mark.parametrize("replicate_with_copy", [False, True])
+def test_dump_to_s3_concurrently(dump_buckets, generated_file, replicate_with_copy):
+    old_dump_to_buckets = CONFIG.dump_to_buckets
+    old_upload_workers = CONFIG.upload_workers
+    old_replicate_with_copy = CONFIG.replicate_with_copy
+    CONFIG.dump_to_buckets = ["dump{}".format(x) for x in range(0, 10)]
+    CONFIG.upload_workers = 4
+    CONFIG.replicate_with_copy = replicate_with_copy
+
+    etags = dump_to_s3(generated_file)
+    assert set(etags) == set(CONFIG.dump_to_buckets)
+
+    for bucket in CONFIG.dump_to_buckets:
+        assert dump_buckets.get_object(Bucket=bucket, Key=CONFIG.dump_to_prefix)["Body"].read() == generated_file
+
+    # Failures are reported per bucket -- and don't stop the other buckets from getting the report:
+    CONFIG.dump_to_buckets = ["dump0", "notabucket", "dump1"]
+    with pytest.raises(ReportUploadError) as exc:
+        with S3StreamingUpload(prefix="partial.json", part_size=5 * 1024 * 1024) as upload:
+            upload.write(b"a" * 6 * 1024 * 1024)
+
+    assert list(exc.value.failures) == ["notabucket"]
+    for bucket in ["dump0", "dump1"]:
+        assert len(dump_buckets.get_object(Bucket=bucket, Key="partial.json")["Body"].read()) == 6 * 1024 * 1024
+
+    # Clean-up:
+    CONFIG.dump_to_buckets = old_dump_to_buckets
+    CONFIG.upload_workers = old_upload_workers
+    CONFIG.replicate_with_copy = old_replicate_with_copy
+
+
+def test_s3_client_pool(dump_buckets, monkeypatch):
+    dump_buckets.create_bucket(Bucket="westbucket", CreateBucketConfiguration={"LocationConstraint": "us-west-2"})
+
+    assert get_s3_client() is get_s3_client(CONFIG.current_region)
+    assert get_bucket_region("dump0") == "us-east-1"
+    assert get_bucket_region("westbucket") == "us-west-2"
+    assert get_bucket_client("westbucket") is get_s3_client("us-west-2")
+    assert get_bucket_client("westbucket").meta.region_name == "us-west-2"
+
+    # Unknown buckets fall back to the current region -- and the failed lookup is not repeated:
+    lookups = []
+    get_bucket_location = get_s3_client().get_bucket_location
+
+    def count_lookups(**kwargs):
+        lookups.append(kwargs["Bucket"])
+        return get_bucket_location(**kwargs)
+
+    monkeypatch.setattr(get_s3_client(), "get_bucket_location", count_lookups)
+    assert get_bucket_region("notaregionbucket") == CONFIG.current_region
+    assert get_bucket_client("notaregionbucket") is get_s3_client()
+    assert lookups == ["notaregionbucket"]
+
+
+def _ordered_report_json(report):
+    """The top-level field order out of the schema is not stable, so pin it for byte comparisons."""
+    return json.dumps({
+        "s3_report_version": report["s3_report_version"],
+        "generated_date": report["generated_date"],
+        "buckets": report["buckets"]
+    }, indent=4).replace("\"<empty>\"", "\"\"").encode("utf-8")
+
+
+def test_write_report_matches_schema(historical_table, generated_report, bucket_event):
+    all_buckets = list(CurrentS3Model.scan())
+    schema_report = S3ReportSchema(strict=True).dump({"all_buckets": all_buckets}).data
+
+    sink = io.BytesIO()
+    write_report(sink, all_buckets, generated_date=schema_report["generated_date"])
+    assert sink.getvalue() == _ordered_report_json(schema_report)
+
+    # With an existing report -- with a new bucket and an updated bucket:
+    updates = [deserialize_records(bucket_event["Records"])[0]["item"], all_buckets[0]]
+    generated_report["all_buckets"] = updates
+    schema_report = S3ReportSchema(strict=True).dump(dict(generated_report,
+                                                          buckets=dict(generated_report["buckets"]))).data
+
+    sink = io.BytesIO()
+    write_report(sink, updates, buckets=generated_report["buckets"], generated_date=schema_report["generated_date"])
+    assert sink.getvalue() == _ordered_report_json(schema_report)
+
+    # And with no buckets at all:
+    sink = io.BytesIO()
+    write_report(sink, [], generated_date=schema_report["generated_date"])
+    assert json.loads(sink.getvalue().decode("utf-8"))["buckets"] == {}
+
+
+@pytest.mark.parametrize("exclude_fields", [[], ["Name", "Tags", "Grants", "NotAField"]])
+def test_bucket_serializer_matches_schema(historical_table, bucket_event, exclude_fields):
+    old_fields = CONFIG.exclude_fields
+    CONFIG.exclude_fields = exclude_fields
+
+    # Both PynamoDB objects and the dicts from the Durable table events (the schema modifies the dicts in place):
+    all_buckets = list(CurrentS3Model.scan())
+    schema_buckets = S3ReportSchema(strict=True).dump({
+        "all_buckets": all_buckets + [deserialize_records(bucket_event["Records"])[0]["item"]]
+    }).data["buckets"]
+
+    serializer = BucketSerializer()
+    event_item = deserialize_records(bucket_event["Records"])[0]["item"]
+    fast_buckets = dict(serializer(item) for item in all_buckets + [event_item])
+    assert "AccountId" not in event_item["configuration"]
+    assert len(fast_buckets) == 11
+
+    # The fields must be in the same order too:
+    assert json.dumps(fast_buckets, indent=4) == json.dumps(schema_buckets, indent=4)
+    for details in fast_buckets.values():
+        assert not set(exclude_fields).intersection(details)
+
+    # Clean-up:
+    CONFIG.exclude_fields = old_fields
+
+
+def test_write_report_empty_placeholders(historical_table, bucket_event):
+    placeholders = {
+        "Value": "<empty>",
+        "<empty>": "key",
+        "Nested": {"List": ["<empty>", "a", {"Deeper": "<empty>"}], "Number": Decimal("1.5")},
+        "NotAPlaceholder": "<empty> and more"
+    }
+
+    item = list(CurrentS3Model.scan())[0]
+    item.configuration["Placeholders"] = placeholders
+    item.save()
+
+    event_item = deserialize_records(bucket_event["Records"])[0]["item"]
+    event_item["configuration"]["Placeholders"] = placeholders
+
+    all_buckets = list(CurrentS3Model.scan())
+    schema_report = S3ReportSchema(strict=True).dump({
+        "all_buckets": all_buckets + [json.loads(json.dumps(event_item, default=float))]
+    }).data
+
+    sink = io.BytesIO()
+    write_report(sink, all_buckets + [event_item], generated_date=schema_report["generated_date"])
+    assert sink.getvalue() == _ordered_report_json(schema_report)
+    assert b"\"<empty>\"" not in sink.getvalue()
+    assert sink.getvalue().count(b"<empty> and more") == 2
+
+    # The items are left alone:
+    assert event_item["configuration"]["Placeholders"]["Value"] == "<empty>"
+    assert "AccountId" not in event_item["configuration"]
+
+
+@pytest.mark.parametrize("backend", [name for name, (module, _, _) in BACKENDS.items() if module])
+def test_json_backends(backend):
+    data = {"whole": Decimal("1"), "fraction": Decimal("1.5"), "nested": {"list": [Decimal("2")]}, "path": "a/b"}
+    assert loads(dumps(data, compact=True, backend=backend), backend=backend) == {
+        "whole": 1, "fraction": 1.5, "nested": {"list": [2]}, "path": "a/b"
+    }
+    assert loads(b'{"a": [1, 2.5, "c"]}', backend=backend) == {"a": [1, 2.5, "c"]}
+
+    # The indented output is always the stdlib output:
+    assert dumps({"a": Decimal("1")}, compact=False, backend=backend) == '{\n    "a": 1\n}'
+
+    assert get_backend("auto") in BACKENDS
+    with pytest.raises(ValueError):
+        get_backend("notabackend")
+
+
+def test_write_compact_report(historical_table):
+    all_buckets = list(CurrentS3Model.scan())
+
+    sink = io.BytesIO()
+    write_report(sink, all_buckets, generated_date="2018-01-01T00:00:00Z")
+    indented = sink.getvalue()
+
+    old_compact = CONFIG.compact_report
+    CONFIG.compact_report = True
+
+    sink = io.BytesIO()
+    write_report(sink, all_buckets, generated_date="2018-01-01T00:00:00Z")
+    compact = sink.getvalue()
+
+    assert b"\n" not in compact
+    assert len(compact) < len(indented)
+    assert json.loads(compact.decode("utf-8")) == json.loads(indented.decode("utf-8"))
+
+    sink = io.BytesIO()
+    write_report(sink, [], generated_date="2018-01-01T00:00:00Z")
+    assert json.loads(sink.getvalue().decode("utf-8"))["buckets"] == {}
+
+    # Clean-up:
+    CONFIG.compact_report = old_compact
+
+
+def test_streaming_upload(dump_buckets):
+    part_size = 5 * 1024 * 1024
+    data = b"a" * part_size * 2 + b"b" * 100
+
+    # Multipart upload:
+    with S3StreamingUpload(buckets=["dump0", "dump1"], prefix="report.json", part_size=part_size) as upload:
+        for x in range(0, len(data), 1024 * 1024):
+            upload.write(data[x:x + 1024 * 1024])
+
+    for bucket in ["dump0", "dump1"]:
+        assert dump_buckets.get_object(Bucket=bucket, Key="report.json")["Body"].read() == data
+
+    # Single part:
+    with S3StreamingUpload(buckets=["dump0"], prefix="small.json", part_size=part_size) as upload:
+        upload.write(b"small")
+    assert dump_buckets.get_object(Bucket="dump0", Key="small.json")["Body"].read() == b"small"
+
+    # Failures abort the upload:
+    with pytest.raises(ValueError):
+        with S3StreamingUpload(buckets=["dump0"], prefix="failed.json", part_size=part_size) as upload:
+            upload.write(data)
+            raise ValueError("Serialization failure")
+    assert not dump_buckets.list_objects_v2(Bucket="dump0", Prefix="failed.json")["KeyCount"]
+    assert not dump_buckets.list_multipart_uploads(Bucket="dump0").get("Uploads")
+
+
+def test_streaming_upload_unexpected_errors(dump_buckets, monkeypatch):
+    part_size = 5 * 1024 * 1024
+    errors = []
+
+    def fail_part(*args, **kwargs):
+        raise ValueError("Part upload failure")
+
+    def fail(self, failures):
+        if failures:
+            raise EndpointConnectionError(endpoint_url="https://s3.amazonaws.com")
+
+    def upload():
+        try:
+            with S3StreamingUpload(buckets=["dump0"], prefix="report.json", part_size=part_size) as upload:
+                for _ in range(0, 10):
+                    upload.write(b"a" * part_size)
+        except Exception as e:
+            errors.append(e)
+
+    monkeypatch.setattr("historical_reports.s3.util._upload_part", fail_part)
+    monkeypatch.setattr(S3StreamingUpload, "_fail", fail)
+
+    # The error is raised to the writer, rather than the writer blocking on the full queue forever:
+    thread = threading.Thread(target=upload, daemon=True)
+    thread.start()
+    thread.join(timeout=60)
+    assert not thread.is_alive()
+    assert isinstance(errors[0], EndpointConnectionError)
+    assert not dump_buckets.list_multipart_uploads(Bucket="dump0").get("Uploads")
+
+    # An error that is only raised once the upload is being completed still aborts it:
+    with pytest.raises(EndpointConnectionError):
+        with S3StreamingUpload(buckets=["dump0"], prefix="report.json", part_size=part_size) as upload:
+            upload.write(b"a" * (part_size + 1))
+
+    assert not dump_buckets.list_multipart_uploads(Bucket="dump0").get("Uploads")
+
+    # Errors that aren't from S3 itself don't stop the aborts:
+    def no_client(bucket):
+        raise EndpointConnectionError(endpoint_url="https://s3.amazonaws.com")
+
+    monkeypatch.setattr("historical_reports.s3.util.get_bucket_client", no_client)
+    S3StreamingUpload(buckets=["dump0"], prefix="report.json")._abort_upload("dump0", "someid")
+
+
+def test_streaming_upload_skips_unchanged(dump_buckets):
+    part_size = 5 * 1024 * 1024
+    data = b"a" * part_size * 2 + b"b" * 100
+
+    def upload_report(data, content_hash):
+        with S3StreamingUpload(buckets=["dump0", "dump1"], prefix="report.json", part_size=part_size) as upload:
+            for x in range(0, len(data), 1024 * 1024):
+                upload.write(data[x:x + 1024 * 1024])
+
+            upload.content_hash = content_hash
+
+        return upload
+
+    # Both multipart and single part uploads:
+    for content_hash, report in [("multipart", data), ("single", b"small")]:
+        upload = upload_report(report, content_hash)
+        assert not upload.skipped
+        etags = upload.etags
+        for bucket in ["dump0", "dump1"]:
+            head = dump_buckets.head_object(Bucket=bucket, Key="report.json")
+            assert head["Metadata"][CONTENT_HASH_METADATA] == content_hash and head["ETag"] == etags[bucket]
+
+        # The same content is not uploaded again (and any multipart uploads are aborted):
+        upload = upload_report(b"not really the same, but the hash is", content_hash)
+        assert sorted(upload.skipped) == ["dump0", "dump1"] and upload.etags == etags
+        assert dump_buckets.get_object(Bucket="dump0", Key="report.json")["Body"].read() == report
+        assert not dump_buckets.list_multipart_uploads(Bucket="dump0").get("Uploads")
+
+        # Only the buckets that changed are uploaded to:
+        dump_buckets.put_object(Bucket="dump1", Key="report.json", Body=b"changed")
+        upload = upload_report(report, content_hash)
+        assert upload.skipped == ["dump0"]
+        assert dump_buckets.get_object(Bucket="dump1", Key="report.json")["Body"].read() == report
+
+    # When replicating with copies, the copies that differ from the unchanged source are replaced:
+    old_replicate_with_copy = CONFIG.replicate_with_copy
+    CONFIG.replicate_with_copy = True
+    upload = upload_report(b"small", "single")
+    assert upload.skipped == ["dump0", "dump1"] and upload.unchanged
+
+    dump_buckets.put_object(Bucket="dump1", Key="report.json", Body=b"changed")
+    upload = upload_report(b"small", "single")
+    assert upload.skipped == ["dump0"] and not upload.unchanged
+    assert dump_buckets.get_object(Bucket="dump1", Key="report.json")["Body"].read() == b"small"
+    assert upload.etags["dump1"] == dump_buckets.head_object(Bucket="dump1", Key="report.json")["ETag"]
+
+    CONFIG.replicate_with_copy = old_replicate_with_copy
+
+
+def test_report_content_hash_ignores_order(dump_buckets):
+    old_skip_unchanged = CONFIG.skip_unchanged
+    CONFIG.skip_unchanged = True
+    entries = [(f"bucket{x}", {"AccountId": "123456789012", "Region": "us-east-1", "Tags": {"x": str(x)}})
+               for x in range(0, 10)]
+
+    def upload_report(entries, generated_date, buckets=("dump0",), indexes=None):
+        with S3StreamingUpload(buckets=list(buckets), prefix="report.json") as upload:
+            writer = ReportWriter(upload, generated_date=generated_date, indexes=indexes)
+            writer.start()
+            for name, details in entries:
+                writer.write_bucket(name, details)
+
+            writer.finish()
+
+        return upload, writer.content_hash
+
+    upload, content_hash = upload_report(entries, "2018-01-01T00:00:00Z")
+    assert not upload.skipped
+    report = dump_buckets.get_object(Bucket="dump0", Key="report.json")["Body"].read()
+
+    # The same content in a different order (and with a different generated date) is not uploaded again:
+    upload, reordered_hash = upload_report(list(reversed(entries)), "2018-01-02T00:00:00Z")
+    assert reordered_hash == content_hash and upload.skipped == ["dump0"]
+    assert dump_buckets.get_object(Bucket="dump0", Key="report.json")["Body"].read() == report
+
+    # But different content is:
+    upload, changed_hash = upload_report(entries[1:], "2018-01-02T00:00:00Z")
+    assert changed_hash != content_hash and not upload.skipped
+
+    # The offsets are not saved when some of the buckets kept a report (that has its buckets in a different order):
+    old_dump_to_buckets = CONFIG.dump_to_buckets
+    CONFIG.dump_to_buckets = ["dump0"]
+    offsets_key = get_index_prefix("offsets", "report.json")
+    upload_report(entries, "2018-01-01T00:00:00Z")
+    indexes = ReportIndexes(secondary=False, offsets=True)
+    upload, _ = upload_report(list(reversed(entries)), "2018-01-02T00:00:00Z", buckets=["dump0", "dump1"],
+                              indexes=indexes)
+    assert upload.skipped == ["dump0"] and not upload.unchanged
+    dump_indexes(indexes, "2018-01-02T00:00:00Z", prefix="report.json", etags=upload.etags, skipped=upload.skipped)
+    assert not dump_buckets.list_objects_v2(Bucket="dump0", Prefix=offsets_key)["KeyCount"]
+
+    # Once every bucket was uploaded to, they are:
+    indexes = ReportIndexes(secondary=False, offsets=True)
+    upload, _ = upload_report(entries[1:], "2018-01-03T00:00:00Z", buckets=["dump0", "dump1"], indexes=indexes)
+    dump_indexes(indexes, "2018-01-03T00:00:00Z", prefix="report.json", etags=upload.etags, skipped=upload.skipped)
+    offsets = json.loads(dump_buckets.get_object(Bucket="dump0", Key=offsets_key)["Body"].read())
+    assert offsets["etags"] == upload.etags and len(offsets["buckets"]) == 9
+
+    # Clean-up:
+    CONFIG.skip_unchanged = old_skip_unchanged
+    CONFIG.dump_to_buckets = old_dump_to_buckets
+
+
+def test_skip_unchanged_reports(existing_s3_report, historical_table, bucket_event, dump_buckets, monkeypatch):
+    old_dump_to_buckets = CONFIG.dump_to_buckets
+    old_import_bucket = CONFIG.import_bucket
+    CONFIG.import_bucket = "dump0"
+    CONFIG.dump_to_buckets = ["dump0"]
+    CONFIG.skip_unchanged = True
+
+    uploads = []
+
+    def upload_to_s3(file, client, bucket, prefix, **kwargs):
+        uploads.append(prefix)
+        return upload(file, client, bucket, prefix, **kwargs)
+
+    upload = historical_reports.s3.util._upload_to_s3
+    monkeypatch.setattr("historical_reports.s3.util._upload_to_s3", upload_to_s3)
+
+    def get_report():
+        return dump_buckets.get_object(Bucket="dump0", Key=CONFIG.import_prefix)
+
+    dump_report()
+    assert uploads == [CONFIG.import_prefix]
+    assert get_report()["Metadata"][CONTENT_HASH_METADATA]
+    report = get_report()["Body"].read()
+
+    dump_report()
+    assert uploads == [CONFIG.import_prefix]
+    assert get_report()["Body"].read() == report
+
+    # The update changes the report -- but the same update again does not:
+    update_records(deserialize_records(bucket_event["Records"]))
+    assert len(uploads) == 2
+    report = get_report()["Body"].read()
+
+    update_records(deserialize_records(bucket_event["Records"]))
+    assert len(uploads) == 2
+    assert get_report()["Body"].read() == report
+
+    # Reports that were saved before the content hash was recorded are re-uploaded:
+    dump_buckets.copy_object(Bucket="dump0", Key=CONFIG.import_prefix, MetadataDirective="REPLACE",
+                             CopySource={"Bucket": "dump0", "Key": CONFIG.import_prefix})
+    update_records(deserialize_records(bucket_event["Records"]))
+    assert len(uploads) == 3
+
+    # Nor are the offset index and the delta of an unchanged report (in any of the report layouts):
+    CONFIG.offset_index = True
+    CONFIG.deltas = True
+    dump_report()
+    assert len(uploads) == 5 and uploads[-1] == get_index_prefix("offsets")
+    dump_report()
+    assert len(uploads) == 5
+
+    update_records(deserialize_records(bucket_event["Records"]))
+    assert len(uploads) == 8
+    update_records(deserialize_records(bucket_event["Records"]))
+    assert len(uploads) == 8
+
+    CONFIG.stream_updates = True
+    update_records(deserialize_records(bucket_event["Records"]))
+    assert len(uploads) == 8
+
+    # Clean-up:
+    CONFIG.dump_to_buckets = old_dump_to_buckets
+    CONFIG.import_bucket = old_import_bucket
+    CONFIG.skip_unchanged = False
+    CONFIG.offset_index = False
+    CONFIG.deltas = False
+    CONFIG.stream_updates = False
+    _REPORT_CACHE.clear()
+
+
 @pytest.mark.parametrize("lambda_entry", [False, True])
 def test_dump_report(dump_buckets, historical_table, lambda_entry):
     old_value = CONFIG.dump_to_buckets
@@ -127,6 +597,348 @@ def test_dump_report(dump_buckets, historical_table, lambda_entry):
     CONFIG.dump_to_buckets = old_value
 
 
+@pytest.mark.parametrize("encoding", [encoding for encoding in ENCODINGS if encoding != "zstd" or zstandard])
+def test_compressed_reports(dump_buckets, historical_table, bucket_event, encoding):
+    old_dump_to_buckets = CONFIG.dump_to_buckets
+    old_import_bucket = CONFIG.import_bucket
+    old_compression = CONFIG.compression
+
+    CONFIG.import_bucket = "dump0"
+    CONFIG.dump_to_buckets = ["dump0", "dump1"]
+    CONFIG.compression = encoding
+
+    assert decompress(compress(b"some data", encoding), encoding) == b"some data"
+
+    dump_report()
+    for bucket in CONFIG.dump_to_buckets:
+        response = dump_buckets.get_object(Bucket=bucket, Key=CONFIG.dump_to_prefix)
+        assert response["ContentEncoding"] == encoding
+        assert response["ContentType"] == "application/json"
+
+        compressed = response["Body"].read()
+        report = json.loads(decompress(compressed, encoding).decode("utf-8"))
+        assert len(report["buckets"]) == 10
+        assert len(compressed) < len(json.dumps(report))
+
+    # The update path reads the compressed report transparently:
+    update_records(deserialize_records(bucket_event["Records"]))
+    report, _ = fetch_from_s3()
+    assert len(json.loads(report)["buckets"]) == 11
+
+    # Multipart uploads (random data doesn't compress, so this takes more than 1 part):
+    data = os.urandom(11 * 1024 * 1024)
+    with S3StreamingUpload(buckets=["dump0"], prefix="random", part_size=5 * 1024 * 1024) as upload:
+        for x in range(0, len(data), 1024 * 1024):
+            upload.write(data[x:x + 1024 * 1024])
+
+    response = dump_buckets.get_object(Bucket="dump0", Key="random")
+    assert response["ContentEncoding"] == encoding
+    assert decompress(response["Body"].read(), encoding) == data
+
+    # Clean-up:
+    CONFIG.dump_to_buckets = old_dump_to_buckets
+    CONFIG.import_bucket = old_import_bucket
+    CONFIG.compression = old_compression
+    _REPORT_CACHE.clear()
+
+
+def test_compression_config():
+    assert get_encoding("") is None
+    assert get_encoding("gzip") == "gzip"
+    assert zlib.decompress(compress(b"data", "gzip"), zlib.MAX_WBITS | 16) == b"data"
+
+    with pytest.raises(ValueError):
+        get_encoding("lzma")
+
+    # Uncompressed objects are returned as-is:
+    assert decompress(b"data", None) == b"data"
+
+
+def test_dump_report_parallel_scan(dump_buckets, historical_table):
+    old_dump_to_buckets = CONFIG.dump_to_buckets
+    old_scan_segments = CONFIG.scan_segments
+    CONFIG.dump_to_buckets = ["dump0"]
+    CONFIG.scan_segments = 4
+
+    dump_report()
+
+    file = json.loads(dump_buckets.get_object(Bucket="dump0", Key=CONFIG.dump_to_prefix)["Body"].read().decode())
+    assert len(file["buckets"]) == 10
+    for name, value in file["buckets"].items():
+        assert value["Tags"]["theBucketName"] == name
+
+    # Clean-up:
+    CONFIG.dump_to_buckets = old_dump_to_buckets
+    CONFIG.scan_segments = old_scan_segments
+
+
+def test_dump_report_pipeline(dump_buckets, historical_table, monkeypatch):
+    old_dump_to_buckets = CONFIG.dump_to_buckets
+    CONFIG.dump_to_buckets = ["dump0"]
+
+    def get_buckets():
+        return json.loads(dump_buckets.get_object(Bucket="dump0", Key=CONFIG.dump_to_prefix)["Body"].read())["buckets"]
+
+    dump_report()
+    buckets = get_buckets()
+
+    # The scan runs on its own thread, and the items are handed over in batches (including a partial batch):
+    threads = []
+    scan = historical_reports.s3.generate._scan
+
+    def threaded_scan(**kwargs):
+        threads.append(threading.current_thread())
+        return scan(**kwargs)
+
+    monkeypatch.setattr("historical_reports.s3.generate._scan", threaded_scan)
+    monkeypatch.setattr("historical_reports.s3.generate.SCAN_BATCH_SIZE", 3)
+    CONFIG.pipeline = True
+    dump_buckets.delete_object(Bucket="dump0", Key=CONFIG.dump_to_prefix)
+
+    dump_report()
+    assert threads and threading.current_thread() not in threads
+    assert get_buckets() == buckets
+
+    # Clean-up:
+    CONFIG.pipeline = False
+    CONFIG.dump_to_buckets = old_dump_to_buckets
+
+
+@pytest.mark.parametrize("scan_segments", [1, 2])
+def test_dump_report_rate_limited_scan(dump_buckets, historical_table, monkeypatch, scan_segments):
+    old_dump_to_buckets = CONFIG.dump_to_buckets
+    old_scan_segments = CONFIG.scan_segments
+    old_scan_rate_limit = CONFIG.scan_rate_limit
+    CONFIG.dump_to_buckets = ["dump0"]
+    CONFIG.scan_segments = scan_segments
+    CONFIG.scan_rate_limit = 4
+
+    sleeps = []
+    monkeypatch.setattr("pynamodb.connection.base.time.sleep", sleeps.append)
+
+    # Throttle the first page of the scan:
+    requests = []
+    scan = Connection.scan
+
+    def throttled_scan(self, table_name, **kwargs):
+        requests.append(kwargs)
+        if len(requests) == 1:
+            raise ScanError("Throttled", ClientError({"Error": {"Code": "ProvisionedThroughputExceededException"}},
+                                                     "Scan"))
+
+        return scan(self, table_name, **kwargs)
+
+    monkeypatch.setattr(Connection, "scan", throttled_scan)
+
+    dump_report()
+
+    file = json.loads(dump_buckets.get_object(Bucket="dump0", Key=CONFIG.dump_to_prefix)["Body"].read().decode())
+    assert len(file["buckets"]) == 10
+
+    # The scan was paced with the consumed capacity, and backed off from the throttling:
+    assert sleeps
+    for kwargs in requests:
+        assert kwargs["return_consumed_capacity"] == "TOTAL"
+        assert kwargs["limit"] == 4 // scan_segments
+        assert kwargs["attributes_to_get"]
+
+    # Clean-up:
+    CONFIG.dump_to_buckets = old_dump_to_buckets
+    CONFIG.scan_segments = old_scan_segments
+    CONFIG.scan_rate_limit = old_scan_rate_limit
+
+
+@pytest.mark.parametrize("scan_segments", [1, 2])
+def test_dump_checkpointed_report(dump_buckets, historical_table, scan_segments):
+    old_dump_to_buckets = CONFIG.dump_to_buckets
+    old_scan_segments = CONFIG.scan_segments
+    CONFIG.dump_to_buckets = ["dump0", "dump1"]
+    CONFIG.scan_segments = scan_segments
+    CONFIG.checkpoint = True
+    CONFIG.checkpoint_items = 3
+    CONFIG.checkpoint_margin = 1000
+
+    # Run out of time part way through the scan:
+    handler({}, ExpiringContext(4))
+    assert not dump_buckets.list_objects_v2(Bucket="dump1")["KeyCount"]
+
+    state = load_state()
+    assert len(state["parts"]) == 2
+    assert state["segments"]["0"]["last_key"] == "arn:aws:s3:::testbucket3"
+    assert not state["segments"]["0"]["complete"]
+
+    staged = dump_buckets.list_objects_v2(Bucket="dump0", Prefix=CONFIG.staging_prefix)["Contents"]
+    assert len(staged) == 3
+
+    # Resume and complete it:
+    handler({}, MockContext())
+
+    for bucket in CONFIG.dump_to_buckets:
+        report = json.loads(dump_buckets.get_object(Bucket=bucket, Key=CONFIG.dump_to_prefix)["Body"].read().decode())
+        assert report["generated_date"] == state["generated_date"]
+        assert sorted(report["buckets"]) == [f"testbucket{x}" for x in range(0, 10)]
+
+    # The staging objects were cleaned up:
+    assert not dump_buckets.list_objects_v2(Bucket="dump0", Prefix=CONFIG.staging_prefix)["KeyCount"]
+    assert not load_state()
+
+    # Clean-up:
+    CONFIG.dump_to_buckets = old_dump_to_buckets
+    CONFIG.scan_segments = old_scan_segments
+    CONFIG.checkpoint = False
+    CONFIG.checkpoint_items = 5000
+    CONFIG.checkpoint_margin = 60 * 1000
+
+
+def test_distributed_report(dump_buckets, historical_table, monkeypatch):
+    old_dump_to_buckets = CONFIG.dump_to_buckets
+    old_invoker = CONFIG.invoker
+
+    invokers = []
+    monkeypatch.setattr("historical_reports.s3.distributed.INVOKERS",
+                        {"local": lambda context: invokers.append(LocalInvoker(context)) or invokers[-1]})
+
+    handler({"report_action": "coordinate", "total_segments": 3,
+             "config": {"dump_to_buckets": ["dump0", "dump1"], "invoker": "local"}}, MockContext())
+
+    # The coordinator invoked 3 workers, and the last worker invoked the reducer:
+    events = invokers[0].events
+    assert [event["report_action"] for event in events] == ["scan_segment"] * 3
+    assert [event["segment"] for event in events] == [0, 1, 2]
+    assert all(event["config"]["invoker"] == "local" for event in events)
+    assert [event["report_action"] for invoker in invokers[1:] for event in invoker.events] == ["reduce"]
+
+    for bucket in ["dump0", "dump1"]:
+        report = json.loads(dump_buckets.get_object(Bucket=bucket, Key=CONFIG.dump_to_prefix)["Body"].read().decode())
+        assert report["generated_date"] == events[0]["generated_date"]
+        assert sorted(report["buckets"]) == [f"testbucket{x}" for x in range(0, 10)]
+        for name, value in report["buckets"].items():
+            assert value["Tags"]["theBucketName"] == name
+
+    # The partial reports were deleted -- and reducing again does nothing:
+    build_id = events[0]["build_id"]
+    assert not dump_buckets.list_objects_v2(Bucket="dump0", Prefix=get_segments_prefix(build_id))["KeyCount"]
+    reduce(dict(events[0], report_action="reduce"))
+
+    # Another reducer deletes the segments in the middle of the merge -- so this one is aborted:
+    class RecordingInvoker:
+        def __init__(self):
+            self.events = []
+
+        def invoke(self, event):
+            self.events.append(event)
+
+    invoker = RecordingInvoker()
+    event = dict(events[0], build_id="concurrent", generated_date="2018-01-01T00:00:00Z")
+    for segment in range(0, 3):
+        scan_segment(dict(event, segment=segment), invoker)
+
+    assert [event["report_action"] for event in invoker.events] == ["reduce"]
+    get_from_s3 = historical_reports.s3.distributed._get_from_s3
+
+    def delete_midway(client, bucket, key):
+        partial = get_from_s3(client, bucket, key)
+        delete_staged(list_staged(get_segments_prefix("concurrent")))
+        return partial
+
+    monkeypatch.setattr("historical_reports.s3.distributed._get_from_s3", delete_midway)
+    reduce(invoker.events[0])
+    report = json.loads(dump_buckets.get_object(Bucket="dump0", Key=CONFIG.dump_to_prefix)["Body"].read().decode())
+    assert report["generated_date"] == events[0]["generated_date"]
+    assert not dump_buckets.list_multipart_uploads(Bucket="dump0").get("Uploads")
+
+    with pytest.raises(ValueError):
+        handler({"report_action": "notanaction"}, MockContext())
+
+    # Clean-up:
+    CONFIG.dump_to_buckets = old_dump_to_buckets
+    CONFIG.invoker = old_invoker
+
+
+def test_generate_from_export(dump_buckets, historical_table, dynamodb, tmpdir):
+    old_dump_to_buckets = CONFIG.dump_to_buckets
+
+    # Make an export of the table (in 2 data files, along with a manifest that is ignored):
+    items = dynamodb.scan(TableName=CurrentS3Model.Meta.table_name)["Items"]
+    tmpdir.mkdir("data")
+    for x, chunk in enumerate([items[:5], items[5:]]):
+        with gzip.open(str(tmpdir.join("data", f"part{x}.json.gz")), "wt") as file:
+            file.write("\n".join(json.dumps({"Item": item}) for item in chunk) + "\n")
+
+    tmpdir.join("manifest-summary.json").write("{}")
+
+    for file in tmpdir.visit(fil=lambda path: path.isfile()):
+        dump_buckets.put_object(Bucket="dump9", Key=f"exports/{file.relto(tmpdir)}", Body=file.read_binary())
+
+    all_buckets = list(CurrentS3Model.scan())
+    scanned_report = S3ReportSchema(strict=True).dump({"all_buckets": all_buckets}).data
+
+    for source in [str(tmpdir), "s3://dump9/exports/"]:
+        result = CliRunner().invoke(cli, ["generate-from-export", source, "--bucket", "dump0,dump1", "-c"])
+        assert result.exit_code == 0, result.output
+
+        for bucket in ["dump0", "dump1"]:
+            report = json.loads(dump_buckets.get_object(Bucket=bucket, Key=CONFIG.dump_to_prefix)["Body"].read())
+            assert report["buckets"] == scanned_report["buckets"]
+
+        dump_buckets.delete_object(Bucket="dump0", Key=CONFIG.dump_to_prefix)
+
+    result = CliRunner().invoke(cli, ["generate-from-export", str(tmpdir.join("notadirectory")), "--bucket", "dump0"])
+    assert isinstance(result.exception, ValueError)
+
+    # Clean-up:
+    CONFIG.dump_to_buckets = old_dump_to_buckets
+
+
+def test_dump_report_views(dump_buckets, historical_table, monkeypatch):
+    old_dump_to_buckets = CONFIG.dump_to_buckets
+    CONFIG.dump_to_buckets = ["dump0"]
+
+    operations = []
+    dispatch = Connection.dispatch
+
+    def record_dispatch(self, operation_name, operation_kwargs):
+        operations.append(operation_name)
+        return dispatch(self, operation_name, operation_kwargs)
+
+    monkeypatch.setattr(Connection, "dispatch", record_dispatch)
+
+    lite_fields = ["Name", "_version", "Grants", "LifecycleRules", "Logging", "Policy", "Tags", "Versioning"]
+    views = [
+        {"prefix": "full.json"},
+        {"prefix": "lite.json", "buckets": ["dump1"], "exclude_fields": lite_fields},
+        {"prefix": "123456789012.json", "filters": {"AccountId": ["123456789012"], "Region": ["us-east-1"]}},
+        {"prefix": "999999999999.json", "filters": {"AccountId": ["999999999999"]}}
+    ]
+    dump_report(views=views)
+
+    # All of the views came from a single scan:
+    assert operations.count("Scan") == 1
+
+    def get_report(bucket, prefix):
+        return json.loads(dump_buckets.get_object(Bucket=bucket, Key=prefix)["Body"].read().decode("utf-8"))
+
+    full = get_report("dump0", "full.json")
+    assert full["buckets"] == S3ReportSchema(strict=True).dump({"all_buckets": CurrentS3Model.scan()}).data["buckets"]
+    assert get_report("dump0", "123456789012.json")["buckets"] == full["buckets"]
+    assert get_report("dump0", "999999999999.json")["buckets"] == {}
+
+    lite = get_report("dump1", "lite.json")
+    assert len(lite["buckets"]) == 10
+    for details in lite["buckets"].values():
+        assert not set(lite_fields).intersection(details)
+        assert details["AccountId"] == "123456789012"
+
+    with pytest.raises(ValueError):
+        dump_report(views=[{"prefix": "bad.json", "filters": {"NotAField": ["value"]}}])
+
+    with pytest.raises(ValueError):
+        dump_report(views=[{"buckets": ["dump0"]}])
+
+    # Clean-up:
+    CONFIG.dump_to_buckets = old_dump_to_buckets
+
+
 def test_process_durable_event(bucket_event, generated_report):
     generated_report["all_buckets"] = []
     records = deserialize_records(bucket_event["Records"])
@@ -155,6 +967,106 @@ def test_process_big_durable_event(bucket_event, generated_report):
     assert generated_report["all_buckets"][0]['BucketName'] == "testbucket0"
 
 
+def test_batch_too_big_durable_events(bucket_event, generated_report, monkeypatch):
+    generated_report["all_buckets"] = []
+    records = []
+    for arn in ["arn:aws:s3:::testbucket0", "arn:aws:s3:::testbucket1", "arn:aws:s3:::testbucketNEWBUCKET"]:
+        record = deserialize_records(bucket_event["Records"])[0]
+        record.pop('item')
+        record.update({'arn': arn, EVENT_TOO_BIG_FLAG: True})
+        records.append(record)
+
+    current_items = fetch_too_big_items(records)
+    assert set(current_items) == {"arn:aws:s3:::testbucket0", "arn:aws:s3:::testbucket1"}
+
+    # None of the records should need to be queried for individually:
+    monkeypatch.setattr(CurrentS3Model, "query", None)
+    generated_report["buckets"]["testbucketNEWBUCKET"] = {"some configuration": "this should be deleted"}
+    for record in records:
+        process_durable_event(record, generated_report, current_items=current_items)
+
+    assert [item['BucketName'] for item in generated_report["all_buckets"]] == ["testbucket0", "testbucket1"]
+    assert not generated_report["buckets"].get("testbucketNEWBUCKET")
+
+    # Nothing to fetch:
+    assert fetch_too_big_items(deserialize_records(bucket_event["Records"])) == {}
+
+
+def test_projection_pushdown(historical_table, bucket_event, monkeypatch):
+    old_fields = CONFIG.exclude_fields
+    CONFIG.exclude_fields = ["Name", "_version", "Tags"]
+
+    requests = []
+    dispatch = Connection.dispatch
+
+    def record_dispatch(self, operation_name, operation_kwargs):
+        requests.append((operation_name, operation_kwargs))
+        return dispatch(self, operation_name, operation_kwargs)
+
+    monkeypatch.setattr(Connection, "dispatch", record_dispatch)
+
+    def projected_attributes(operation_kwargs):
+        names = operation_kwargs["ExpressionAttributeNames"]
+        return {names[name] for name in operation_kwargs["ProjectionExpression"].split(", ")}
+
+    report_attributes = {"arn", "BucketName", "accountId", "Region", "configuration"}
+
+    # The full report's scan:
+    dump_report(commit=False)
+    scans = [kwargs for operation, kwargs in requests if operation == "Scan"]
+    assert scans
+    for scan in scans:
+        assert projected_attributes(scan) == report_attributes
+
+    # The lookups of the records that were too big:
+    requests.clear()
+    record = deserialize_records(bucket_event["Records"])[0]
+    record.update({'arn': "arn:aws:s3:::testbucket0", EVENT_TOO_BIG_FLAG: True})
+    current_items = fetch_too_big_items([record])
+    item = _fetch_current_item("arn:aws:s3:::testbucket0")
+
+    for item in [current_items["arn:aws:s3:::testbucket0"], item]:
+        assert item["BucketName"] == "testbucket0"
+        assert item["version"] and item["eventTime"] and "Tags" in item
+
+    batch_get = next(kwargs for operation, kwargs in requests if operation == "BatchGetItem")
+    assert projected_attributes(batch_get["RequestItems"][CurrentS3Model.Meta.table_name]) == \
+        report_attributes | {"eventTime", "version"}
+
+    query = next(kwargs for operation, kwargs in requests if operation == "Query")
+    assert projected_attributes(query) == report_attributes | {"eventTime", "version"}
+
+    # Throttled lookups are backed off from and retried:
+    throttles = []
+    monkeypatch.setattr("retrying.time.sleep", lambda seconds: None)
+
+    def throttle_dispatch(self, operation_name, operation_kwargs):
+        if operation_name == "BatchGetItem" and len(throttles) < 2:
+            throttles.append(operation_name)
+            raise ClientError({"Error": {"Code": "ProvisionedThroughputExceededException", "Message": "Slow down"}},
+                              operation_name)
+
+        return record_dispatch(self, operation_name, operation_kwargs)
+
+    monkeypatch.setattr(Connection, "dispatch", throttle_dispatch)
+    assert list(fetch_too_big_items([record])) == ["arn:aws:s3:::testbucket0"]
+    assert len(throttles) == 2
+
+    # But other errors are not:
+    def fail_dispatch(self, operation_name, operation_kwargs):
+        throttles.append(operation_name)
+        raise ClientError({"Error": {"Code": "AccessDeniedException", "Message": "Nope"}}, operation_name)
+
+    monkeypatch.setattr(Connection, "dispatch", fail_dispatch)
+    with pytest.raises(GetError):
+        fetch_too_big_items([record])
+
+    assert len(throttles) == 3
+
+    # Clean-up:
+    CONFIG.exclude_fields = old_fields
+
+
 def test_process_durable_event_deletion(delete_bucket_event, generated_report):
     generated_report["all_buckets"] = []
     records = deserialize_records(delete_bucket_event["Records"])
@@ -269,6 +1181,507 @@ def test_update_records(existing_s3_report, historical_table, bucket_event, dele
     CONFIG.import_bucket = old_import_bucket
 
 
+@pytest.mark.parametrize("parser", ["ijson", "raw_decode"])
+def test_iterate_report_buckets(historical_table, monkeypatch, parser):
+    if parser == "ijson" and not historical_reports.s3.reader.ijson:
+        pytest.skip("ijson is not installed.")
+
+    if parser == "raw_decode":
+        monkeypatch.setattr("historical_reports.s3.reader.ijson", None)
+
+    # Tiny chunks, so that the values (and multi-byte characters) are split up between them:
+    monkeypatch.setattr("historical_reports.s3.reader.READ_CHUNK_SIZE", 7)
+
+    buckets = dict(BucketSerializer()(item) for item in CurrentS3Model.scan())
+    buckets["testbucketÜnicode"] = {"Tags": {"ключ": "值"}, "Size": 1234567, "Ratio": 0.5, "Empty": {},
+                                    "List": [1, []]}
+    for compact in [False, True]:
+        sink = io.BytesIO()
+        write_report(sink, [], buckets=dict(buckets), generated_date="2018-01-01T00:00:00Z")
+        report = sink.getvalue() if not compact else \
+            json.dumps(json.loads(sink.getvalue()), separators=(",", ":")).encode("utf-8")
+        assert list(iterate_report_buckets(io.BytesIO(report))) == list(buckets.items())
+
+    # The buckets don't need to be the last member, and can be empty:
+    report = json.dumps({"buckets": {"a": {"b": 1}}, "generated_date": "x", "s3_report_version": 1}).encode("utf-8")
+    assert list(iterate_report_buckets(io.BytesIO(report))) == [("a", {"b": 1})]
+    assert not list(iterate_report_buckets(io.BytesIO(b'{"generated_date": "x", "buckets": {}}')))
+
+    with pytest.raises(ValueError):
+        list(iterate_report_buckets(io.BytesIO(b'{"buckets": {"a": {"b": 1}')))
+
+    # Numbers that are split up at every point between the chunks:
+    report = b'{"s3_report_version": 1.5, "other": -12.5e+3, "buckets": {"a": 1.25E-10, "b": {"c": 0.5}, "d": 10}}'
+    for chunk_size in range(1, 20):
+        monkeypatch.setattr("historical_reports.s3.reader.READ_CHUNK_SIZE", chunk_size)
+        assert list(iterate_report_buckets(io.BytesIO(report))) == [("a", 1.25E-10), ("b", {"c": 0.5}), ("d", 10)]
+
+
+@pytest.mark.parametrize("encoding", [None] + [encoding for encoding in ENCODINGS if encoding != "zstd" or zstandard])
+def test_stream_update_records(existing_s3_report, historical_table, bucket_event, delete_bucket_event, dump_buckets,
+                               encoding):
+    old_dump_to_buckets = CONFIG.dump_to_buckets
+    old_import_bucket = CONFIG.import_bucket
+    CONFIG.import_bucket = "dump0"
+    CONFIG.dump_to_buckets = ["dump0"]
+    CONFIG.compression = encoding
+    CONFIG.deltas = True
+
+    def get_report():
+        body, _ = fetch_from_s3()
+        return json.loads(body)
+
+    # Both ways of updating make the same report:
+    dump_report()
+    update_records(deserialize_records(bucket_event["Records"]))
+    in_memory = get_report()
+
+    dump_report()
+    _REPORT_CACHE.clear()
+    CONFIG.stream_updates = True
+    update_records(deserialize_records(bucket_event["Records"]))
+    streamed = get_report()
+    assert list(streamed["buckets"].items()) == list(in_memory["buckets"].items())
+    assert not _REPORT_CACHE
+
+    # The existing entries are updated in place:
+    update_records(deserialize_records(bucket_event["Records"]))
+    assert list(get_report()["buckets"].items()) == list(in_memory["buckets"].items())
+
+    update_records(deserialize_records(delete_bucket_event["Records"]))
+    report = get_report()
+    assert len(report["buckets"]) == 10 and "testbucketNEWBUCKET" not in report["buckets"]
+
+    added, modified, deleted = [json.loads(decompress(dump_buckets.get_object(Bucket="dump0", Key=key)["Body"].read(),
+                                                      encoding)) for key in list_deltas()[-3:]]
+    assert list(added["added"]) == list(modified["modified"]) == deleted["deleted"] == ["testbucketNEWBUCKET"]
+
+    # Without the commit flag, nothing is saved:
+    update_records(deserialize_records(bucket_event["Records"]), commit=False)
+    assert get_report() == report
+
+    # Clean-up:
+    CONFIG.stream_updates = False
+    CONFIG.compression = None
+    CONFIG.deltas = False
+    CONFIG.dump_to_buckets = old_dump_to_buckets
+    CONFIG.import_bucket = old_import_bucket
+    _REPORT_CACHE.clear()
+
+
+def test_report_indexes(historical_table, bucket_event, delete_bucket_event, dump_buckets):
+    old_dump_to_buckets = CONFIG.dump_to_buckets
+    old_import_bucket = CONFIG.import_bucket
+    CONFIG.import_bucket = "dump0"
+    CONFIG.dump_to_buckets = ["dump0"]
+    CONFIG.indexes = True
+
+    def get_index(index):
+        return json.loads(dump_buckets.get_object(Bucket="dump0", Key=get_index_prefix(index))["Body"].read())
+
+    dump_report()
+    assert get_index_prefix("account") == "historical-s3-report/indexes/account.json"
+
+    names = [f"testbucket{x}" for x in range(0, 10)]
+    account = get_index("account")
+    assert account["index"] == {"123456789012": names}
+    assert account["generated_date"] and account["s3_report_version"] == CONFIG.s3_reports_version
+    assert get_index("region")["index"] == {"us-east-1": names}
+    assert get_index("tag")["index"] == {"theBucketName": {name: [name] for name in names}}
+
+    # Kept up to date with the updates:
+    update_records(deserialize_records(bucket_event["Records"]))
+    assert get_index("account")["index"] == {"123456789012": sorted(names + ["testbucketNEWBUCKET"])}
+    assert get_index("tag")["index"]["theBucketName"]["testbucketNEWBUCKET"] == ["testbucketNEWBUCKET"]
+
+    update_records(deserialize_records(delete_bucket_event["Records"]))
+    assert get_index("account")["index"] == {"123456789012": names}
+    assert "testbucketNEWBUCKET" not in get_index("tag")["index"]["theBucketName"]
+
+    # Clean-up:
+    CONFIG.dump_to_buckets = old_dump_to_buckets
+    CONFIG.import_bucket = old_import_bucket
+    CONFIG.indexes = False
+    _REPORT_CACHE.clear()
+
+
+def test_offset_index(historical_table, bucket_event, dump_buckets):
+    old_dump_to_buckets = CONFIG.dump_to_buckets
+    old_import_bucket = CONFIG.import_bucket
+    CONFIG.import_bucket = "dump0"
+    CONFIG.dump_to_buckets = ["dump0"]
+    CONFIG.offset_index = True
+
+    def get_offsets():
+        return json.loads(dump_buckets.get_object(Bucket="dump0", Key=get_index_prefix("offsets"))["Body"].read())
+
+    def check_entries(offsets):
+        report = json.loads(dump_buckets.get_object(Bucket="dump0", Key=CONFIG.import_prefix)["Body"].read())
+        assert offsets["etags"]["dump0"] == dump_buckets.head_object(Bucket="dump0", Key=CONFIG.import_prefix)["ETag"]
+        assert sorted(offsets["buckets"]) == sorted(report["buckets"])
+        for name, details in report["buckets"].items():
+            assert fetch_bucket_entry(name, offsets) == details
+
+    # Both the indented and the compact reports:
+    for compact in [False, True]:
+        CONFIG.compact_report = compact
+        dump_report()
+        offsets = get_offsets()
+        assert len(offsets["buckets"]) == 10
+        check_entries(offsets)
+
+    assert not fetch_bucket_entry("notabucket", offsets)
+
+    # The secondary indexes are not saved unless they are also enabled:
+    with pytest.raises(ClientError):
+        dump_buckets.get_object(Bucket="dump0", Key=get_index_prefix("account"))
+
+    # Kept up to date with the updates:
+    update_records(deserialize_records(bucket_event["Records"]))
+    offsets = get_offsets()
+    assert "testbucketNEWBUCKET" in offsets["buckets"]
+    check_entries(offsets)
+
+    # Not made for compressed reports:
+    CONFIG.compression = "gzip"
+    assert not historical_reports.s3.indexes.new_indexes()
+
+    # Clean-up:
+    CONFIG.compression = None
+    CONFIG.compact_report = False
+    CONFIG.dump_to_buckets = old_dump_to_buckets
+    CONFIG.import_bucket = old_import_bucket
+    CONFIG.offset_index = False
+    _REPORT_CACHE.clear()
+
+
+def test_deltas(historical_table, bucket_event, delete_bucket_event, dump_buckets):
+    old_dump_to_buckets = CONFIG.dump_to_buckets
+    old_import_bucket = CONFIG.import_bucket
+    CONFIG.import_bucket = "dump0"
+    CONFIG.dump_to_buckets = ["dump0", "dump1"]
+    CONFIG.deltas = True
+
+    def get_object(key, bucket="dump0"):
+        return json.loads(dump_buckets.get_object(Bucket=bucket, Key=key)["Body"].read())
+
+    # No deltas for the full report:
+    dump_report()
+    assert not list_deltas()
+
+    # Added, modified and then deleted:
+    for event in [bucket_event, bucket_event, delete_bucket_event]:
+        update_records(deserialize_records(event["Records"]))
+
+    keys = list_deltas()
+    assert len(keys) == 3 and keys[0].startswith("historical-s3-report/deltas/")
+    added, modified, deleted = [get_object(key) for key in keys]
+    report = get_object(CONFIG.import_prefix)
+    assert list(added["added"]) == ["testbucketNEWBUCKET"] and not added["modified"] and not added["deleted"]
+    assert list(modified["modified"]) == ["testbucketNEWBUCKET"] and not modified["added"]
+    assert deleted["deleted"] == ["testbucketNEWBUCKET"] and not deleted["added"] and not deleted["modified"]
+    assert deleted["generated_date"] == report["generated_date"]
+    assert deleted["etags"]["dump0"] == dump_buckets.head_object(Bucket="dump0", Key=CONFIG.import_prefix)["ETag"]
+
+    # The deltas are mirrored to all of the dump buckets:
+    assert get_object(keys[0], bucket="dump1") == added
+
+    # Nothing is old enough to be compacted yet:
+    assert not compact_deltas()
+
+    # Compacting: the bucket was added and then deleted, so there are no net changes:
+    update_records(deserialize_records(bucket_event["Records"]))
+    snapshot_key = compact_deltas(before=datetime.utcnow() + timedelta(seconds=1))
+    assert snapshot_key.startswith("historical-s3-report/deltas/snapshots/")
+    assert not list_deltas()
+    for bucket in ["dump0", "dump1"]:
+        snapshot = get_object(snapshot_key, bucket=bucket)
+        assert list(snapshot["added"]) == ["testbucketNEWBUCKET"]
+        assert not snapshot["modified"] and not snapshot["deleted"]
+
+    # A bucket that was deleted and then re-created was modified:
+    snapshot = {"added": {}, "modified": {}, "deleted": set()}
+    fold_delta(snapshot, deleted)
+    fold_delta(snapshot, added)
+    assert snapshot["modified"] == added["added"] and not snapshot["added"] and not snapshot["deleted"]
+
+    # Clean-up:
+    CONFIG.dump_to_buckets = old_dump_to_buckets
+    CONFIG.import_bucket = old_import_bucket
+    CONFIG.deltas = False
+    _REPORT_CACHE.clear()
+
+
+def test_update_records_report_cache(existing_s3_report, historical_table, bucket_event, dump_buckets, monkeypatch):
+    old_dump_to_buckets = CONFIG.dump_to_buckets
+    old_import_bucket = CONFIG.import_bucket
+
+    CONFIG.import_bucket = "dump0"
+    CONFIG.dump_to_buckets = ["dump0"]
+    _REPORT_CACHE.clear()
+
+    update_records(deserialize_records(bucket_event["Records"]))
+
+    # The report that was just written is cached along with its ETag:
+    cached = _REPORT_CACHE[("dump0", CONFIG.import_prefix)]
+    assert cached["etag"] == dump_buckets.head_object(Bucket="dump0", Key=CONFIG.import_prefix)["ETag"]
+    assert len(cached["report"]["buckets"]) == 11
+
+    # An unchanged report is not downloaded or deserialized again:
+    def not_modified(etag=None, prefix=None):
+        assert etag == cached["etag"]
+        return NOT_MODIFIED, etag
+
+    monkeypatch.setattr("historical_reports.s3.update.fetch_from_s3", not_modified)
+    monkeypatch.setattr("historical_reports.s3.update.loads", None)
+    cached["report"]["buckets"]["cachedbucket"] = {"AccountId": "123456789012"}
+
+    update_records(deserialize_records(bucket_event["Records"]))
+    new_report = json.loads(dump_buckets.get_object(Bucket="dump0", Key=CONFIG.import_prefix)["Body"].read().decode())
+    assert len(new_report["buckets"]) == 12
+    assert new_report["buckets"]["cachedbucket"]
+
+    # Clean-up:
+    _REPORT_CACHE.clear()
+    CONFIG.dump_to_buckets = old_dump_to_buckets
+    CONFIG.import_bucket = old_import_bucket
+
+
+def test_update_records_fragment_cache(existing_s3_report, historical_table, bucket_event, delete_bucket_event,
+                                      dump_buckets, monkeypatch):
+    old_dump_to_buckets = CONFIG.dump_to_buckets
+    old_import_bucket = CONFIG.import_bucket
+    CONFIG.import_bucket = "dump0"
+    CONFIG.dump_to_buckets = ["dump0"]
+    _REPORT_CACHE.clear()
+
+    encoded = []
+    encode = ReportWriter._encode
+
+    def count_encodes(self, name, details):
+        encoded.append(name)
+        return encode(self, name, details)
+
+    monkeypatch.setattr(ReportWriter, "_encode", count_encodes)
+
+    # Moto ignores the `IfNoneMatch`:
+    def fetch(etag=None, prefix=None):
+        if etag == dump_buckets.head_object(Bucket="dump0", Key=prefix)["ETag"]:
+            return NOT_MODIFIED, etag
+
+        return fetch_from_s3(etag=etag, prefix=prefix)
+
+    monkeypatch.setattr("historical_reports.s3.update.fetch_from_s3", fetch)
+
+    def get_report():
+        return dump_buckets.get_object(Bucket="dump0", Key=CONFIG.import_prefix)["Body"].read()
+
+    # The first update after loading the report encodes everything:
+    update_records(deserialize_records(bucket_event["Records"]))
+    assert len(encoded) == 11
+    fragments = _REPORT_CACHE[("dump0", CONFIG.import_prefix)]["report"]["fragments"]
+    assert len(fragments) == 11
+
+    # After that, only the changed entries are:
+    encoded.clear()
+    update_records(deserialize_records(bucket_event["Records"]))
+    assert encoded == ["testbucketNEWBUCKET"]
+    cached_report = get_report()
+
+    update_records(deserialize_records(delete_bucket_event["Records"]))
+    assert encoded == ["testbucketNEWBUCKET"]
+    assert len(fragments) == 10
+
+    # The spliced together report is the same as a freshly encoded one:
+    update_records(deserialize_records(bucket_event["Records"]))
+    assert get_report() == cached_report
+    _REPORT_CACHE.clear()
+    update_records(deserialize_records(bucket_event["Records"]))
+    assert get_report()[get_report().index(b"\"buckets\""):] == cached_report[cached_report.index(b"\"buckets\""):]
+
+    # A change in the layout throws out the fragments:
+    CONFIG.compact_report = True
+    encoded.clear()
+    update_records(deserialize_records(bucket_event["Records"]))
+    assert len(encoded) == 11
+    assert json.loads(get_report())["buckets"] == json.loads(cached_report)["buckets"]
+
+    # Clean-up:
+    CONFIG.compact_report = False
+    CONFIG.dump_to_buckets = old_dump_to_buckets
+    CONFIG.import_bucket = old_import_bucket
+    _REPORT_CACHE.clear()
+
+
+def test_get_from_s3_not_modified():
+    client = get_s3_client()
+    with Stubber(client) as stubber:
+        stubber.add_client_error("get_object", service_error_code="304", http_status_code=304)
+        assert _get_from_s3(client, "dump0", "historical-s3-report.json", etag="\"someetag\"") == \
+            (NOT_MODIFIED, "\"someetag\"")
+
+
+def test_get_sibling_prefix():
+    assert get_sibling_prefix("manifest", "some/report.json") == "some/report/manifest.json"
+    assert get_sibling_prefix("indexes/accounts", "report") == "report/indexes/accounts"
+    assert get_sibling_prefix("deltas/", "some/report.json") == "some/report/deltas/"
+    assert get_sibling_prefix("manifest") == f"{os.path.splitext(CONFIG.dump_to_prefix)[0]}/manifest.json"
+
+
+def test_get_from_s3_errors(monkeypatch):
+    monkeypatch.setattr("retrying.time.sleep", lambda seconds: None)
+    client = get_s3_client()
+    with Stubber(client) as stubber:
+        for _ in range(0, 3):
+            stubber.add_client_error("get_object", service_error_code="AccessDenied", http_status_code=403)
+
+        # Retried, and then raised (rather than returning nothing):
+        with pytest.raises(ClientError):
+            _get_from_s3(client, "dump0", "historical-s3-report.json")
+
+        stubber.assert_no_pending_responses()
+
+
+def test_sharded_report(historical_table, dump_buckets, bucket_event, delete_bucket_event, caplog):
+    old_dump_to_buckets = CONFIG.dump_to_buckets
+    old_import_bucket = CONFIG.import_bucket
+    old_shard_by = CONFIG.shard_by
+
+    CONFIG.import_bucket = "dump0"
+    CONFIG.dump_to_buckets = ["dump0", "dump1"]
+    CONFIG.shard_by = ["AccountId", "Region"]
+
+    # Add in a bucket in a different account and region:
+    other_bucket = dict(CurrentS3Model.query("arn:aws:s3:::testbucket0").next())
+    other_bucket.update(arn="arn:aws:s3:::otherbucket", BucketName="otherbucket", accountId="210987654321",
+                        Region="us-west-2")
+    CurrentS3Model(**other_bucket).save()
+
+    # Checkpointing is not supported for the sharded report -- which is called out:
+    CONFIG.checkpoint = True
+    dump_report()
+    CONFIG.checkpoint = False
+    assert "Checkpointing is not supported for the sharded report" in caplog.text
+
+    for bucket in CONFIG.dump_to_buckets:
+        manifest = json.loads(dump_buckets.get_object(Bucket=bucket, Key="historical-s3-report/manifest.json")[
+            "Body"].read().decode())
+        assert manifest["shard_by"] == ["AccountId", "Region"]
+        assert set(manifest["shards"]) == {"123456789012/us-east-1", "210987654321/us-west-2"}
+
+        for shard, details in manifest["shards"].items():
+            obj = dump_buckets.get_object(Bucket=bucket, Key=details["prefix"])
+            assert obj["ETag"] == details["etag"]
+
+            shard_report = json.loads(obj["Body"].read().decode())
+            assert len(shard_report["buckets"]) == details["bucket_count"]
+            for value in shard_report["buckets"].values():
+                assert "/".join([value["AccountId"], value["Region"]]) == shard
+
+    assert manifest["shards"]["123456789012/us-east-1"]["bucket_count"] == 10
+    assert manifest["shards"]["210987654321/us-west-2"]["bucket_count"] == 1
+
+    # Updates only touch the shards that the records are in:
+    update_records(deserialize_records(bucket_event["Records"]))
+
+    new_manifest = json.loads(dump_buckets.get_object(Bucket="dump0", Key="historical-s3-report/manifest.json")[
+        "Body"].read().decode())
+    assert new_manifest["shards"]["123456789012/us-east-1"]["bucket_count"] == 11
+    assert new_manifest["shards"]["123456789012/us-east-1"]["etag"] != \
+        manifest["shards"]["123456789012/us-east-1"]["etag"]
+    assert new_manifest["shards"]["210987654321/us-west-2"] == manifest["shards"]["210987654321/us-west-2"]
+
+    shard_report = json.loads(dump_buckets.get_object(Bucket="dump0", Key="historical-s3-report/123456789012/"
+                                                                          "us-east-1.json")["Body"].read().decode())
+    assert shard_report["buckets"]["testbucketNEWBUCKET"]
+
+    # Only the last shard that was saved is cached:
+    update_records(deserialize_records(bucket_event["Records"]) +
+                   [{"arn": "arn:aws:s3:::otherbucket", EVENT_TOO_BIG_FLAG: True}])
+    assert len(_REPORT_CACHE) == 1
+
+    # Deletions -- including ones that were too big to know where the bucket was:
+    update_records(deserialize_records(delete_bucket_event["Records"]))
+    record = {"arn": "arn:aws:s3:::otherbucket", EVENT_TOO_BIG_FLAG: True}
+    CurrentS3Model("arn:aws:s3:::otherbucket").delete()
+    update_records([record])
+
+    new_manifest = json.loads(dump_buckets.get_object(Bucket="dump0", Key="historical-s3-report/manifest.json")[
+        "Body"].read().decode())
+    assert new_manifest["shards"]["123456789012/us-east-1"]["bucket_count"] == 10
+    assert not new_manifest["shards"].get("210987654321/us-west-2")
+
+    # Clean-up:
+    _REPORT_CACHE.clear()
+    CONFIG.dump_to_buckets = old_dump_to_buckets
+    CONFIG.import_bucket = old_import_bucket
+    CONFIG.shard_by = old_shard_by
+
+
+def test_coalesce_records(bucket_event, delete_bucket_event):
+    created = deserialize_records(bucket_event["Records"])[0]
+    deleted = deserialize_records(delete_bucket_event["Records"])[0]
+    other = deserialize_records(bucket_event["Records"])[0]
+    other["item"]["BucketName"] = "otherbucket"
+    too_big = {"arn": "arn:aws:s3:::testbucketNEWBUCKET", "event_time": "2017-11-10T18:33:40Z",
+               EVENT_TOO_BIG_FLAG: True}
+
+    created["event_time"] = "2017-11-10T18:33:44Z"
+    deleted["event_time"] = "2017-11-10T18:33:50Z"
+
+    # The newest event for each bucket wins -- regardless of where it is in the batch:
+    assert coalesce_records([created, other, deleted, too_big]) == [deleted, other]
+    assert coalesce_records([deleted, created, other]) == [deleted, other]
+
+    # Ties go to the later record:
+    deleted["event_time"] = created["event_time"]
+    assert coalesce_records([deleted, created]) == [created]
+
+    # Events older than what has already been applied are dropped:
+    watermarks = {"testbucketNEWBUCKET": ("2017-11-10T18:34:00Z", 9)}
+    assert coalesce_records([created, other], watermarks=watermarks) == [other]
+
+
+def test_update_records_coalesced(existing_s3_report, historical_table, bucket_event, delete_bucket_event,
+                                  dump_buckets, monkeypatch):
+    old_dump_to_buckets = CONFIG.dump_to_buckets
+    old_import_bucket = CONFIG.import_bucket
+
+    CONFIG.import_bucket = "dump0"
+    CONFIG.dump_to_buckets = ["dump0"]
+    _REPORT_CACHE.clear()
+
+    # Moto does not support conditional GETs:
+    def fetch_from_s3(etag=None, prefix=None):
+        if etag and etag == dump_buckets.head_object(Bucket="dump0", Key=CONFIG.import_prefix)["ETag"]:
+            return NOT_MODIFIED, etag
+
+        return real_fetch_from_s3(etag=etag, prefix=prefix)
+
+    real_fetch_from_s3 = historical_reports.s3.update.fetch_from_s3
+    monkeypatch.setattr("historical_reports.s3.update.fetch_from_s3", fetch_from_s3)
+
+    created = deserialize_records(bucket_event["Records"])[0]
+    deleted = deserialize_records(delete_bucket_event["Records"])[0]
+    deleted["event_time"] = "2017-11-10T18:35:00Z"
+
+    # Created and deleted within the same batch:
+    update_records([deleted, created])
+    report = json.loads(dump_buckets.get_object(Bucket="dump0", Key=CONFIG.import_prefix)["Body"].read().decode())
+    assert len(report["buckets"]) == 10
+    assert not report["buckets"].get("testbucketNEWBUCKET")
+
+    # A stale creation that arrives in a later batch is dropped by the warm container:
+    update_records([deserialize_records(bucket_event["Records"])[0]])
+    report = json.loads(dump_buckets.get_object(Bucket="dump0", Key=CONFIG.import_prefix)["Body"].read().decode())
+    assert not report["buckets"].get("testbucketNEWBUCKET")
+
+    # Clean-up:
+    _REPORT_CACHE.clear()
+    CONFIG.dump_to_buckets = old_dump_to_buckets
+    CONFIG.import_bucket = old_import_bucket
+
+
 def test_update_records_sans_existing(historical_table, dump_buckets, bucket_event):
     old_dump_to_buckets = CONFIG.dump_to_buckets
     old_import_bucket = CONFIG.import_bucket
@@ -285,14 +1698,17 @@ def test_update_records_sans_existing(historical_table, dump_buckets, bucket_eve
     update_records(bucket_event["Records"], commit=False)
     assert not dump_buckets.list_objects_v2(Bucket="dump0")["KeyCount"]
 
-    # Now with commit:
+    # Now with commit (the report views are not what is re-generated):
+    old_report_views = CONFIG.report_views
+    CONFIG.report_views = [{"prefix": "lite.json"}]
     update_records(bucket_event["Records"])
-    assert len(dump_buckets.list_objects_v2(Bucket="dump0")["Contents"]) == 1
+    assert [obj["Key"] for obj in dump_buckets.list_objects_v2(Bucket="dump0")["Contents"]] == [CONFIG.import_prefix]
 
     # Clean-up:
     CONFIG.dump_to_buckets = old_dump_to_buckets
     CONFIG.import_bucket = old_import_bucket
     CONFIG.export_if_missing = old_export_if_missing
+    CONFIG.report_views = old_report_views
 
 
 def test_configuration_update():
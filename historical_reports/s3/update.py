@@ -5,34 +5,162 @@
     :license: Apache, see LICENSE for more details.
 .. author:: Mike Grima <mgrima@netflix.com>
 """
-import json
 import logging
+import os
+from collections import defaultdict
+from contextlib import closing
 
+from botocore.exceptions import ClientError
 from historical.constants import LOGGING_LEVEL, EVENT_TOO_BIG_FLAG
-from historical.attributes import decimal_default
 from historical.s3.models import CurrentS3Model
+from pynamodb.exceptions import GetError
+from retrying import retry
 
+from historical_reports.s3.deltas import diff_changes, dump_delta
 from historical_reports.s3.generate import dump_report
-from historical_reports.s3.models import S3ReportSchema
-from historical_reports.s3.util import fetch_from_s3, dump_to_s3
+from historical_reports.s3.indexes import dump_indexes, new_indexes
+from historical_reports.s3.json_backend import loads
+from historical_reports.s3.models import S3ReportSchema, get_generated_time
+from historical_reports.s3.reader import iterate_report_buckets
+from historical_reports.s3.serialize import get_projection, item_to_dict, write_report, BucketSerializer, \
+    FragmentCache, ReportWriter, ITEM_ATTRIBUTES
+from historical_reports.s3.shards import add_shard, dump_manifest, fetch_manifest, get_shard, get_shard_prefix
+from historical_reports.s3.util import fetch_from_s3, open_report_stream, S3StreamingUpload, NOT_MODIFIED
 from historical_reports.s3.config import CONFIG
 
 logging.basicConfig()
 log = logging.getLogger('historical-reports-s3')
 log.setLevel(LOGGING_LEVEL)
 
+# Besides what's needed for the report, the events are ordered by these:
+EVENT_ATTRIBUTES = ("eventTime", "version")
+
+# BatchGetItem can fetch up to 100 items at a time:
+BATCH_GET_SIZE = 100
+
+# The number of times that a throttled `BatchGetItem` is backed off from and retried before giving up:
+MAX_BATCH_GET_ATTEMPTS = 5
+
+THROTTLING_ERRORS = ("ProvisionedThroughputExceededException", "ThrottlingException", "RequestLimitExceeded")
+
+# The last report that was saved to S3 -- kept for the life of the (warm) Lambda container. Only the one report is
+# kept, so that the shards of a sharded report don't all pile up in memory:
+_REPORT_CACHE = {}
+
+
+def _deleted_item(arn):
+    return {'configuration': {}, 'BucketName': arn.split('arn:aws:s3:::')[1]}
+
+
+def _fetch_current_item(arn):
+    """Fetches the item for a record that was too big to be shipped over from the Current S3 table."""
+    result = list(CurrentS3Model.query(arn, attributes_to_get=get_projection(EVENT_ATTRIBUTES)))
+
+    # Is the record too big and also not found in the Current Table? Then delete it:
+    if not result:
+        return _deleted_item(arn)
+
+    return item_to_dict(result[0], attributes=ITEM_ATTRIBUTES + EVENT_ATTRIBUTES)
+
+
+def _bucket_name(record):
+    if record.get('item'):
+        return record['item']['BucketName']
+
+    return record['arn'].split('arn:aws:s3:::')[1]
+
+
+def _event_order(record):
+    """The order of the events for a bucket is by the `eventTime`, and then by the `version`."""
+    item = record.get('item') or {}
+    return record.get('event_time') or item.get('eventTime') or "", item.get('version') or 0
+
+
+def coalesce_records(records, watermarks=None):
+    """
+    Coalesces the batch of records down to just the newest event for each bucket, so that a bucket that was created,
+    modified and deleted within the same batch is only looked up and serialized once.
+
+    The report does not record when each entry was last changed, so `watermarks` keeps track of the newest event that
+    was applied to each bucket. It lives with the report in the warm container cache. Events older than that are stale
+    and are dropped.
+    :param records: The batch of Durable table records.
+    :param watermarks: Optional dict of the bucket names to the order of the last event that was applied to them.
+    :return: The list of the newest records for each bucket.
+    """
+    latest = {}
+    for record in records:
+        name = _bucket_name(record)
+
+        # Ties go to the record that came later in the batch:
+        if name not in latest or _event_order(record) >= _event_order(latest[name]):
+            latest[name] = record
+
+    coalesced = []
+    for name, record in latest.items():
+        if watermarks and name in watermarks and _event_order(record) < watermarks[name]:
+            log.debug(f"[/] Dropping stale event for: {name}.")
+            continue
+
+        coalesced.append(record)
+
+    log.debug(f"[+] Coalesced {len(records)} records down to {len(coalesced)}.")
+
+    return coalesced
 
-def process_durable_event(record, s3_report):
-    """Processes a group of Historical Durable Table events."""
-    if record.get(EVENT_TOO_BIG_FLAG):
-        result = list(CurrentS3Model.query(record['arn']))
 
-        # Is the record too big and also not found in the Current Table? Then delete it:
-        if not result:
-            record['item'] = {'configuration': {}, 'BucketName': record['arn'].split('arn:aws:s3:::')[1]}
+def update_watermarks(watermarks, records):
+    """Records the events that were just applied as the newest for their buckets."""
+    for record in records:
+        watermarks[_bucket_name(record)] = _event_order(record)
+
+
+def _is_throttled(exception):
+    return isinstance(exception, GetError) and isinstance(exception.cause, ClientError) and \
+        exception.cause.response['Error']['Code'] in THROTTLING_ERRORS
+
+
+@retry(stop_max_attempt_number=MAX_BATCH_GET_ATTEMPTS, wait_exponential_multiplier=1000,
+       wait_exponential_max=10000, retry_on_exception=_is_throttled)
+def _batch_get_items(arns):
+    return {item.arn: item_to_dict(item, attributes=ITEM_ATTRIBUTES + EVENT_ATTRIBUTES)
+            for item in CurrentS3Model.batch_get(arns, attributes_to_get=get_projection(EVENT_ATTRIBUTES))}
+
+
+def fetch_too_big_items(records):
+    """
+    Fetches the items for all of the records that were too big to be shipped over from the Current S3 table with
+    `BatchGetItem` -- rather than querying for each record one at a time. The keys are fetched in chunks of 100 (the
+    `BatchGetItem` limit), and PynamoDB re-requests any unprocessed keys. A chunk that is still throttled after
+    PynamoDB's own retries is backed off from and retried (up to `MAX_BATCH_GET_ATTEMPTS` times).
+    :param records: The batch of Durable table records.
+    :return: Dict of the ARNs to the items that were found.
+    """
+    arns = sorted({record['arn'] for record in records if record.get(EVENT_TOO_BIG_FLAG)})
+    if not arns:
+        return {}
 
+    log.debug(f"[@] Fetching {len(arns)} items that were too big to ship from the Current table.")
+    items = {}
+    for x in range(0, len(arns), BATCH_GET_SIZE):
+        items.update(_batch_get_items(arns[x:x + BATCH_GET_SIZE]))
+
+    return items
+
+
+def process_durable_event(record, s3_report, current_items=None):
+    """
+    Processes a group of Historical Durable Table events.
+    :param record: The Durable table record.
+    :param s3_report: The report to apply the record to.
+    :param current_items: The items from `fetch_too_big_items`. If not supplied, the items for records that were too
+                          big are queried for individually.
+    """
+    if record.get(EVENT_TOO_BIG_FLAG):
+        if current_items is None:
+            record['item'] = _fetch_current_item(record['arn'])
         else:
-            record['item'] = dict(result[0])
+            record['item'] = current_items.get(record['arn']) or _deleted_item(record['arn'])
 
     if not record['item']['configuration']:
         log.debug(f"[ ] Processing deletion for: {record['item']['BucketName']}")
@@ -42,45 +170,253 @@ def process_durable_event(record, s3_report):
         s3_report["all_buckets"].append(record['item'])
 
 
-def update_records(records, commit=True):
-    log.debug("[@] Starting Record Update.")
+def load_report(prefix=None):
+    """
+    Fetches and deserializes the existing report from S3.
 
-    # First, grab the existing JSON from S3:
-    existing_json = fetch_from_s3()
-    log.debug("[+] Grabbed all the existing data from S3.")
+    The deserialized report is cached in memory along with its ETag. Subsequent loads only re-download the report if
+    it no longer matches that ETag -- otherwise the cached report is used.
 
-    # If the existing JSON is not present for some reason, then...
+    NOTE: The cached report is handed out as-is and is popped from the cache. Callers that modify the report must
+          call `cache_report` once the modified report is saved.
+    :param prefix: Defaults to `CONFIG.import_prefix`.
+    :return: The deserialized report, or None if it does not exist.
+    """
+    location = (CONFIG.import_bucket, prefix or CONFIG.import_prefix)
+    cached = _REPORT_CACHE.pop(location, None)
+
+    existing_json, etag = fetch_from_s3(etag=cached["etag"] if cached else None, prefix=location[1])
+    if existing_json is NOT_MODIFIED:
+        log.debug(f"[+] {location[1]} has not changed -- using the cached report.")
+        return cached["report"]
+
+    log.debug(f"[+] Grabbed all the existing data from S3 for {location[1]}.")
     if not existing_json:
-        if commit and CONFIG.export_if_missing:
-            CONFIG.dump_to_buckets = CONFIG.import_bucket.split(",")
-            CONFIG.dump_to_prefix = CONFIG.import_prefix
-            log.info("[!] The report does not exist. Dumping the full report to {}/{}".format(CONFIG.import_bucket,
-                                                                                              CONFIG.import_prefix))
-            dump_report()
+        return None
+
+    report = S3ReportSchema().load(loads(existing_json)).data
+    report.pop("all_buckets", None)
+    report["watermarks"] = {}
+    report["fragments"] = FragmentCache()
+
+    return report
+
+
+def cache_report(report, upload, prefix=None):
+    """
+    Caches the report that was just saved -- provided that it was saved to the location that is imported from. This
+    replaces any other report that was cached.
+    :param report: The report that was saved.
+    :param upload: The `S3StreamingUpload` that saved the report.
+    :param prefix: The import location of the report. Defaults to `CONFIG.import_prefix`.
+    """
+    prefix = prefix or CONFIG.import_prefix
+    etag = upload.etags.get(CONFIG.import_bucket)
+    if etag and upload.prefix == prefix:
+        _REPORT_CACHE.clear()
+        _REPORT_CACHE[(CONFIG.import_bucket, prefix)] = {"etag": etag, "report": report}
+
+
+def _report_missing(commit):
+    """The existing report is not present for some reason, so dump out the full report if configured to do so."""
+    if commit and CONFIG.export_if_missing:
+        CONFIG.dump_to_buckets = CONFIG.import_bucket.split(",")
+        CONFIG.dump_to_prefix = CONFIG.import_prefix
+        log.info("[!] The report does not exist. Dumping the full report to {}/{}".format(CONFIG.import_bucket,
+                                                                                          CONFIG.import_prefix))
+        # The report that is being updated is re-generated -- not the configured report views:
+        dump_report(views=[])
+
+    else:
+        log.error("[X] The existing log was not present and the `EXPORT_IF_MISSING` env var was "
+                  "not set so exiting.")
+
+
+def update_sharded_records(records, commit=True):
+    """
+    Updates a sharded report (see `historical_reports.s3.shards`). Only the shards that the records belong in are
+    fetched and re-written, followed by the manifest.
+    """
+    manifest = fetch_manifest()
+    if not manifest:
+        _report_missing(commit)
+        return
+
+    # Group up the records by the shard that they belong in:
+    records = coalesce_records(records)
+    current_items = fetch_too_big_items(records)
+    shard_records = defaultdict(list)
+    for record in records:
+        if record.get(EVENT_TOO_BIG_FLAG):
+            record = {key: value for key, value in record.items() if key != EVENT_TOO_BIG_FLAG}
+            record['item'] = current_items.get(record['arn']) or _deleted_item(record['arn'])
+
+        shard = get_shard(record['item'], shard_by=manifest["shard_by"])
+        if shard:
+            shard_records[shard].append(record)
 
         else:
-            log.error("[X] The existing log was not present and the `EXPORT_IF_MISSING` env var was "
-                      "not set so exiting.")
+            # This is a deletion without the details of where the bucket was -- so it needs to check all the shards:
+            log.warning(f"[!] Unable to determine the shard for: {record['item']['BucketName']}. Checking all shards.")
+            for shard in manifest["shards"]:
+                shard_records[shard].append(record)
+
+    generated_date = get_generated_time()
+    for shard, records in shard_records.items():
+        prefix = get_shard_prefix(shard, CONFIG.import_prefix)
+        report = (load_report(prefix=prefix) if shard in manifest["shards"] else None) or \
+            {"buckets": {}, "watermarks": {}, "fragments": FragmentCache()}
+        report["all_buckets"] = []
+
+        records = coalesce_records(records, watermarks=report["watermarks"])
+        bucket_count = len(report["buckets"])
+        for record in records:
+            process_durable_event(record, report)
+
+        update_watermarks(report["watermarks"], records)
+
+        if not report["all_buckets"] and len(report["buckets"]) == bucket_count:
+            log.debug(f"[/] No changes to shard: {shard}.")
+            continue
+
+        if commit:
+            log.debug(f"[-->] Saving shard: {shard} to S3.")
+            with S3StreamingUpload(prefix=get_shard_prefix(shard)) as upload:
+                writer = write_report(upload, report.pop("all_buckets"), buckets=report["buckets"],
+                                      generated_date=generated_date, fragments=report["fragments"])
+
+            cache_report(report, upload, prefix=prefix)
+            add_shard(manifest, shard, upload.etags, writer.bucket_count)
+
+    if commit:
+        manifest["generated_date"] = generated_date
+        dump_manifest(manifest)
+
+    else:
+        log.debug("[/] Commit flag not set, not saving.")
+
+
+def stream_update_records(records, commit=True):
+    """
+    Updates the report without loading it into memory. The existing report is streamed in from S3 one bucket entry at
+    a time (see `historical_reports.s3.reader`), the records are applied to the entries as they go by, and the updated
+    report is streamed back out to S3 -- so only the changes for the batch (and the names of the buckets) are ever
+    held in memory, regardless of the size of the report.
+
+    The report is not kept in the warm container cache, so the events are not checked against the watermarks of the
+    previous batches.
+    """
+    stream = open_report_stream()
+    if not stream:
+        _report_missing(commit)
+        return
+
+    # The serialized entries for the batch (or None for the deletions):
+    records = coalesce_records(records)
+    current_items = fetch_too_big_items(records)
+    serializer = BucketSerializer()
+    changes = {}
+    for record in records:
+        if record.get(EVENT_TOO_BIG_FLAG):
+            record['item'] = current_items.get(record['arn']) or _deleted_item(record['arn'])
+
+        if record['item']['configuration']:
+            name, details = serializer(record['item'])
+            changes[name] = details
+        else:
+            changes[record['item']['BucketName']] = None
+
+    indexes = new_indexes() if commit else None
+    previous = set()
+    with closing(stream), S3StreamingUpload() if commit else open(os.devnull, "wb") as sink:
+        writer = ReportWriter(sink, indexes=indexes)
+        writer.start()
+        for name, details in iterate_report_buckets(stream):
+            if name in changes:
+                previous.add(name)
+                details = changes[name]
 
+            if details is not None:
+                writer.write_bucket(name, details)
+
+        # The new buckets go at the end of the report:
+        for name, details in changes.items():
+            if details is not None and name not in previous:
+                writer.write_bucket(name, details)
+
+        writer.finish()
+
+    if not commit:
+        log.debug("[/] Commit flag not set, not saving.")
+        return
+
+    if sink.unchanged:
+        log.debug("[/] The report has not changed -- not saving the indexes nor the delta.")
+        return
+
+    dump_indexes(indexes, writer.generated_date, etags=sink.etags, skipped=sink.skipped)
+    if CONFIG.deltas:
+        upserts = {name: details for name, details in changes.items() if details is not None}
+        dump_delta(*diff_changes(upserts, previous, ()), writer.generated_date, etags=sink.etags)
+
+
+def update_records(records, commit=True):
+    log.debug("[@] Starting Record Update.")
+
+    if CONFIG.shard_by:
+        update_sharded_records(records, commit=commit)
+        log.debug("[@] Completed S3 report update.")
+        return
+
+    if CONFIG.stream_updates:
+        stream_update_records(records, commit=commit)
+        log.debug("[@] Completed S3 report update.")
+        return
+
+    # First, grab the existing report from S3 (or from the cache):
+    report = load_report()
+
+    # If the existing JSON is not present for some reason, then...
+    if not report:
+        _report_missing(commit)
         return
 
-    # Deserialize the report:
-    report = S3ReportSchema().loads(existing_json).data
     report["all_buckets"] = []
 
+    # Only the newest event for each bucket needs to be applied:
+    records = coalesce_records(records, watermarks=report["watermarks"])
+
+    # The buckets of the batch that are already in the report (for the delta):
+    previous = {_bucket_name(record) for record in records} & report["buckets"].keys()
+
+    current_items = fetch_too_big_items(records)
     for record in records:
-        process_durable_event(record, report)
+        process_durable_event(record, report, current_items=current_items)
 
-    # Serialize the data:
-    generated_file = S3ReportSchema(strict=True).dump(report).data
+    update_watermarks(report["watermarks"], records)
 
-    # Dump to S3:
+    # Serialize the data and dump to S3:
     if commit:
         log.debug("[-->] Saving to S3.")
+        serializer = BucketSerializer()
+        changes = dict(serializer(item) for item in report.pop("all_buckets"))
+        delta = diff_changes(changes, previous, report["buckets"]) if CONFIG.deltas else None
+        report["buckets"].update(changes)
+
+        indexes = new_indexes()
+        with S3StreamingUpload() as upload:
+            writer = write_report(upload, [], buckets=report["buckets"], indexes=indexes,
+                                  fragments=report["fragments"])
+
+        cache_report(report, upload)
+        if upload.unchanged:
+            log.debug("[/] The report has not changed -- not saving the indexes nor the delta.")
+
+        else:
+            dump_indexes(indexes, writer.generated_date, etags=upload.etags, skipped=upload.skipped)
+            if delta:
+                dump_delta(*delta, writer.generated_date, etags=upload.etags)
 
-        # Replace <empty> with "" <-- Due to Pynamo/Dynamo issues...
-        dump_to_s3(json.dumps(generated_file, indent=4, default=decimal_default).replace("\"<empty>\"", "\"\"").encode(
-            "utf-8"))
     else:
         log.debug("[/] Commit flag not set, not saving.")
 
@@ -5,13 +5,21 @@
     :license: Apache, see LICENSE for more details.
 .. author:: Mike Grima <mgrima@netflix.com>
 """
+import os
+import queue
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
 import boto3
-from botocore.exceptions import ClientError
+from botocore.config import Config as BotoConfig
+from botocore.exceptions import BotoCoreError, ClientError
 from retrying import retry
 
 from historical.constants import LOGGING_LEVEL
 
+from historical_reports.s3.compression import compress, decompress, get_compressor, get_encoding, open_decompressed
 from historical_reports.s3.config import CONFIG
+from historical_reports.s3.json_backend import loads
 
 import logging
 
@@ -19,47 +27,577 @@ logging.basicConfig()
 log = logging.getLogger('historical-reports-s3')
 log.setLevel(LOGGING_LEVEL)
 
+# The number of full parts that can be waiting to be uploaded before writes will block:
+MAX_PENDING_PARTS = 2
+
+# Returned when fetching an object that has not changed since the supplied ETag:
+NOT_MODIFIED = object()
+
+# The S3 object metadata key of the report's content hash (see `S3StreamingUpload`):
+CONTENT_HASH_METADATA = "report-content-hash"
+
+# DeleteObjects can delete up to 1000 objects at a time:
+MAX_DELETE_OBJECTS = 1000
+
+# These are kept around for the life of the (warm) Lambda container:
+_CLIENTS = {}
+_BUCKET_REGIONS = {}
+_CLIENT_LOCK = threading.Lock()
+
+
+def get_s3_client(region=None):
+    """
+    Returns the S3 client for the region. Clients are created once per region and then re-used, so that the client
+    construction and the connection (and TLS) setup are not paid on every invocation.
+    :param region: Defaults to `CONFIG.current_region`.
+    :return:
+    """
+    region = region or CONFIG.current_region
+
+    with _CLIENT_LOCK:
+        if not _CLIENTS.get(region):
+            log.debug(f"[ ] Creating the S3 client for: {region}")
+            _CLIENTS[region] = boto3.client("s3", region_name=region,
+                                            config=BotoConfig(max_pool_connections=CONFIG.max_pool_connections))
+
+        return _CLIENTS[region]
+
+
+def get_bucket_region(bucket):
+    """
+    Looks up (and caches) the region that the bucket resides in. If it can't be looked up, then the current region is
+    cached for the bucket instead -- so that the failing lookup is not repeated for every S3 call.
+    """
+    if not _BUCKET_REGIONS.get(bucket):
+        try:
+            location = get_s3_client().get_bucket_location(Bucket=bucket)["LocationConstraint"]
+
+        except ClientError as ce:
+            log.warning(f"[!] Unable to determine the region for bucket: {bucket} -- using the current region: {ce}")
+            _BUCKET_REGIONS[bucket] = CONFIG.current_region
+            return _BUCKET_REGIONS[bucket]
+
+        # Buckets in us-east-1 have no location constraint, and "EU" is the legacy name for eu-west-1:
+        _BUCKET_REGIONS[bucket] = {None: "us-east-1", "": "us-east-1", "EU": "eu-west-1"}.get(location, location)
+
+    return _BUCKET_REGIONS[bucket]
+
+
+def get_bucket_client(bucket):
+    """Returns the S3 client for the region that the bucket resides in."""
+    return get_s3_client(get_bucket_region(bucket))
+
+
+def get_sibling_prefix(suffix, prefix=None):
+    """
+    Returns the S3 prefix of an object that lives under the report prefix (without the extension), like the shards and
+    the indexes. The report's extension is added onto the suffix -- unless the suffix is a "directory" (ends in "/").
+    :param suffix: The name of the object under the report prefix, like: "indexes/accounts".
+    :param prefix: The prefix of the report. Defaults to `CONFIG.dump_to_prefix`.
+    """
+    base, extension = os.path.splitext(prefix or CONFIG.dump_to_prefix)
+    return f"{base}/{suffix}{'' if suffix.endswith('/') else extension}"
+
+
+def delete_objects(bucket, keys):
+    """Deletes the objects from the bucket -- in batches of as many as DeleteObjects allows."""
+    client = get_bucket_client(bucket)
+    for x in range(0, len(keys), MAX_DELETE_OBJECTS):
+        client.delete_objects(Bucket=bucket, Delete={
+            "Objects": [{"Key": key} for key in keys[x:x + MAX_DELETE_OBJECTS]],
+            "Quiet": True
+        })
+
+
+class ReportUploadError(Exception):
+    """Raised when the report could not be saved to one or more of the dump buckets."""
+    def __init__(self, failures):
+        self.failures = failures
+        super().__init__("Failed to save the report to: {}".format(
+            ", ".join(f"{bucket} ({error})" for bucket, error in failures.items())))
+
+
+@retry(stop_max_attempt_number=3, wait_exponential_multiplier=1000, wait_exponential_max=10000)
+def _upload_to_s3(file, client, bucket, prefix, content_type="application/json", content_encoding=None,
+                  metadata=None):
+    kwargs = {"ContentEncoding": content_encoding} if content_encoding else {}
+    if metadata:
+        kwargs["Metadata"] = metadata
+
+    return client.put_object(Bucket=bucket, Key=prefix, Body=file, ContentType=content_type, **kwargs)["ETag"]
+
+
+@retry(stop_max_attempt_number=3, wait_exponential_multiplier=1000, wait_exponential_max=10000)
+def _upload_part(part, client, bucket, prefix, upload_id, part_number):
+    return client.upload_part(Bucket=bucket, Key=prefix, UploadId=upload_id, PartNumber=part_number,
+                              Body=part)["ETag"]
+
+
+@retry(stop_max_attempt_number=3, wait_exponential_multiplier=1000, wait_exponential_max=10000)
+def _copy_in_s3(client, source_bucket, bucket, prefix):
+    # CopyObject is limited to 5GB objects -- which is well beyond the size of any report:
+    return client.copy_object(Bucket=bucket, Key=prefix, CopySource={"Bucket": source_bucket, "Key": prefix},
+                              MetadataDirective="COPY")["CopyObjectResult"]["ETag"]
+
 
 @retry(stop_max_attempt_number=3, wait_exponential_multiplier=1000, wait_exponential_max=10000)
-def _upload_to_s3(file, client, bucket, prefix, content_type="application/json"):
-    client.put_object(Bucket=bucket, Key=prefix, Body=file, ContentType=content_type)
+def _replace_metadata_in_s3(client, bucket, prefix, content_type="application/json", content_encoding=None,
+                            metadata=None):
+    """Replaces the metadata of the object with an in-place server-side copy."""
+    kwargs = {"ContentEncoding": content_encoding} if content_encoding else {}
+    return client.copy_object(Bucket=bucket, Key=prefix, CopySource={"Bucket": bucket, "Key": prefix},
+                              MetadataDirective="REPLACE", ContentType=content_type, Metadata=metadata or {},
+                              **kwargs)["CopyObjectResult"]["ETag"]
 
 
 @retry(stop_max_attempt_number=3, wait_exponential_multiplier=1000, wait_exponential_max=10000)
-def _get_from_s3(client, bucket, prefix):
+def _head_from_s3(client, bucket, prefix):
+    """Returns the `HeadObject` response of the object, or None if it does not exist."""
     try:
-        return client.get_object(Bucket=bucket, Key=prefix)["Body"].read().decode()
+        return client.head_object(Bucket=bucket, Key=prefix)
+
     except ClientError as ce:
-        if ce.response['Error']['Code'] == 'NoSuchKey':
+        if ce.response['Error']['Code'] in ['404', 'NoSuchKey', 'NotFound']:
             return None
 
+        raise
+
+
+@retry(stop_max_attempt_number=3, wait_exponential_multiplier=1000, wait_exponential_max=10000)
+def _get_from_s3(client, bucket, prefix, etag=None):
+    try:
+        if etag:
+            response = client.get_object(Bucket=bucket, Key=prefix, IfNoneMatch=etag)
+        else:
+            response = client.get_object(Bucket=bucket, Key=prefix)
+
+        # Compressed reports are decompressed based on their Content-Encoding:
+        return decompress(response["Body"].read(), response.get("ContentEncoding")).decode(), response["ETag"]
+
+    except ClientError as ce:
+        if ce.response['Error']['Code'] == 'NoSuchKey':
+            return None, None
+
+        if ce.response['Error']['Code'] in ['304', 'NotModified']:
+            return NOT_MODIFIED, etag
+
+        log.error("[X] Unable to fetch {}/{}: {}".format(bucket, prefix, ce))
+        raise
+
+
+@retry(stop_max_attempt_number=3, wait_exponential_multiplier=1000, wait_exponential_max=10000,
+       retry_on_exception=lambda e: not (isinstance(e, ClientError) and
+                                         e.response['Error']['Code'] in ['412', 'PreconditionFailed']))
+def _get_range_from_s3(client, bucket, prefix, offset, length, etag=None):
+    kwargs = {"IfMatch": etag} if etag else {}
+    response = client.get_object(Bucket=bucket, Key=prefix, Range=f"bytes={offset}-{offset + length - 1}", **kwargs)
 
-def dump_to_s3(file):
+    return response["Body"].read()
+
+
+def _for_each_bucket(func, buckets, prefix):
+    """
+    Calls `func(bucket)` for each of the buckets on a bounded pool of `CONFIG.upload_workers` threads.
+    Errors are logged and returned per bucket -- a failure for one bucket does not stop the others.
+    :return: A tuple of the `{bucket: result}` for the successful buckets, and the `{bucket: exception}` for the
+             failures.
+    """
+    results = {}
+    failures = {}
+    if not buckets:
+        return results, failures
+
+    with ThreadPoolExecutor(max_workers=max(1, min(CONFIG.upload_workers, len(buckets)))) as executor:
+        futures = {bucket: executor.submit(func, bucket) for bucket in buckets}
+
+    for bucket, future in futures.items():
+        try:
+            results[bucket] = future.result()
+        except Exception as e:
+            log.error("[X] Failed to save the report to {}/{}: {}".format(bucket, prefix, e))
+            failures[bucket] = e
+
+    return results, failures
+
+
+def _replicate(source_bucket, buckets, prefix):
+    """Copies the report object in the source bucket over to the other buckets with server-side copies."""
+    def copy(bucket):
+        log.debug("[-->] Copying {}/{} to {}/{}".format(source_bucket, prefix, bucket, prefix))
+        return _copy_in_s3(get_bucket_client(bucket), source_bucket, bucket, prefix)
+
+    return _for_each_bucket(copy, buckets, prefix)
+
+
+def _save_to_buckets(save, buckets, prefix):
+    """
+    Saves the report to all of the buckets with `save(bucket)`.
+
+    If `CONFIG.replicate_with_copy` is set, then the report is only saved to the first bucket, and then copied over to
+    the remaining buckets with server-side copies.
+    :return: A tuple of the `{bucket: ETag}` for the successful buckets and the `{bucket: exception}` for the failures.
+    """
+    if not CONFIG.replicate_with_copy:
+        return _for_each_bucket(save, buckets, prefix)
+
+    etags, failures = _for_each_bucket(save, buckets[:1], prefix)
+    if failures:
+        log.error("[X] Unable to save to the source bucket -- not replicating to the other buckets.")
+        return etags, failures
+
+    copied, failures = _replicate(buckets[0], buckets[1:], prefix)
+    etags.update(copied)
+
+    return etags, failures
+
+
+def dump_to_s3(file, prefix=None):
     """
     This will dump the generated schema to S3.
-    :param blob:
-    :return:
+
+    The buckets are uploaded to concurrently with up to `CONFIG.upload_workers` threads. The report is compressed if
+    `CONFIG.compression` is set.
+    :param file: The blob of the report to upload.
+    :param prefix: Defaults to `CONFIG.dump_to_prefix`.
+    :return: Dict of the dump buckets to the ETags of the uploaded report.
     """
-    client = boto3.client("s3")
+    prefix = prefix or CONFIG.dump_to_prefix
+    encoding = get_encoding()
+    if encoding:
+        file = compress(file, encoding)
 
-    # Loop over each bucket and dump:
-    for bucket in CONFIG.dump_to_buckets:
-        log.debug("[-->] Dumping to {}/{}".format(bucket, CONFIG.dump_to_prefix))
-        _upload_to_s3(file, client, bucket, CONFIG.dump_to_prefix)
+    def upload(bucket):
+        log.debug("[-->] Dumping to {}/{}".format(bucket, prefix))
+        etag = _upload_to_s3(file, get_bucket_client(bucket), bucket, prefix, content_encoding=encoding)
         log.debug("[+] Complete")
 
+        return etag
+
+    etags, failures = _save_to_buckets(upload, CONFIG.dump_to_buckets, prefix)
+    if failures:
+        raise ReportUploadError(failures)
+
     log.debug("[+] Completed dumping to all buckets.")
 
+    return etags
 
-def fetch_from_s3():
+
+class S3StreamingUpload:
+    """
+    Write-only, file-like object that streams the report out to all of the dump buckets.
+
+    Written bytes are buffered up into parts of `CONFIG.multipart_chunk_size`. Each full part is handed off to a
+    background thread that uploads it as an S3 multipart upload part, so uploading overlaps with the serialization.
+    At most `MAX_PENDING_PARTS` parts are queued up at any time, which keeps the memory usage bounded regardless of the
+    size of the report. If the whole report fits within a single part, then a normal `PutObject` is made instead.
+
+    If `CONFIG.compression` is set (or `content_encoding` is supplied), then the written bytes are compressed as they
+    are written, and the object is saved with that `Content-Encoding`.
+
+    If the `content_hash` of what was written is set before the upload is closed (the `ReportWriter` sets it when
+    `CONFIG.skip_unchanged` is set), then it is saved as object metadata. Buckets that already have an object with the
+    same content hash are skipped: a single part report is not uploaded to them, and a multipart upload is aborted. As
+    the hash is only known at the end, multipart uploads get the metadata with an in-place server-side copy. When
+    replicating with server-side copies, the copies are checked against the hash too. If all of the buckets were
+    skipped, then `unchanged` is set -- and the objects that describe the report (like the indexes) should not be
+    re-written either, as the kept report may have its buckets in a different order.
+
+    Each part is sent to the buckets concurrently (see `dump_to_s3`). A bucket that fails is dropped from the upload
+    and the rest carry on -- all failures are raised together as a `ReportUploadError` at the end.
+
+    Use it as a context manager -- the upload is completed on exit, or aborted if an exception was raised:
+    ```
+    with S3StreamingUpload() as upload:
+        upload.write(b"...")
+    ```
+    """
+    def __init__(self, buckets=None, prefix=None, part_size=None, content_type="application/json",
+                 content_encoding=None):
+        self.buckets = buckets or CONFIG.dump_to_buckets
+        self.prefix = prefix or CONFIG.dump_to_prefix
+        self.part_size = part_size or CONFIG.multipart_chunk_size
+        self.content_type = content_type
+        self.content_encoding = get_encoding(content_encoding)
+        self.content_hash = None
+        self.etags = {}
+        self.skipped = []  # The buckets that already had the same content
+
+        self._compressor = get_compressor(self.content_encoding) if self.content_encoding else None
+
+        # When replicating with server-side copies, only the first bucket is uploaded to:
+        self._targets = self.buckets[:1] if CONFIG.replicate_with_copy else self.buckets
+
+        self._buffer = bytearray()
+        self._parts = queue.Queue(maxsize=MAX_PENDING_PARTS)
+        self._upload_ids = {}
+        self._completed_parts = {bucket: [] for bucket in self._targets}
+        self._failures = {}
+        self._uploader = None
+        self._error = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type:
+            self.abort()
+        else:
+            self.close()
+
+    @property
+    def _object_args(self):
+        args = {"ContentType": self.content_type}
+        if self.content_encoding:
+            args["ContentEncoding"] = self.content_encoding
+
+        return args
+
+    @property
+    def unchanged(self):
+        """Set if the report was not saved to any of the buckets, as they all already had the same content."""
+        return bool(self.skipped) and set(self.skipped) == set(self.buckets)
+
+    @property
+    def _metadata(self):
+        return {CONTENT_HASH_METADATA: self.content_hash} if self.content_hash else {}
+
+    def write(self, data):
+        self._buffer += self._compressor.compress(data) if self._compressor else data
+        self._send_full_parts()
+
+    def _send_full_parts(self):
+        # Only send off parts once there is more than a full part, so single part reports are a plain PutObject:
+        while len(self._buffer) > self.part_size:
+            part = bytes(self._buffer[:self.part_size])
+            del self._buffer[:self.part_size]
+            self._submit(part)
+
+    def _submit(self, part):
+        if not self._uploader:
+            def create(bucket):
+                log.debug("[-->] Starting multipart upload to {}/{}".format(bucket, self.prefix))
+                return get_bucket_client(bucket).create_multipart_upload(Bucket=bucket, Key=self.prefix,
+                                                                         **self._object_args)["UploadId"]
+
+            self._upload_ids, failures = _for_each_bucket(create, self._targets, self.prefix)
+            self._fail(failures)
+
+            self._uploader = threading.Thread(target=self._upload_parts, daemon=True)
+            self._uploader.start()
+
+        if self._error:
+            raise self._error
+
+        self._parts.put(part)
+
+    def _fail(self, failures):
+        """Drops the failed buckets from the upload. If there is nothing left to upload to, then stop."""
+        for bucket in failures:
+            upload_id = self._upload_ids.pop(bucket, None)
+            if upload_id:
+                self._abort_upload(bucket, upload_id)
+
+        self._failures.update(failures)
+        if self._failures and not self._upload_ids:
+            self._error = ReportUploadError(self._failures)
+
+    def _upload_parts(self):
+        part_number = 0
+        while True:
+            part = self._parts.get()
+            if part is None:
+                return
+
+            # Keep draining the queue after a failure so that the writer never blocks:
+            if self._error:
+                continue
+
+            part_number += 1
+
+            def upload(bucket):
+                etag = _upload_part(part, get_bucket_client(bucket), bucket, self.prefix, self._upload_ids[bucket],
+                                    part_number)
+                self._completed_parts[bucket].append({"ETag": etag, "PartNumber": part_number})
+
+            # Anything unexpected stops the upload -- but the thread carries on draining the queue:
+            try:
+                _, failures = _for_each_bucket(upload, list(self._upload_ids), self.prefix)
+                self._fail(failures)
+
+            except Exception as e:
+                log.error("[X] The multipart upload to {} failed: {}".format(self.prefix, e))
+                self._error = e
+                continue
+
+            log.debug(f"[+] Uploaded part {part_number}.")
+
+    def _stop_uploader(self):
+        if self._uploader and self._uploader.is_alive():
+            self._parts.put(None)
+            self._uploader.join()
+
+    def _find_unchanged(self, buckets):
+        """Returns the `{bucket: ETag}` of the buckets that already have an object with the same content hash."""
+        def check(bucket):
+            head = _head_from_s3(get_bucket_client(bucket), bucket, self.prefix)
+            if head and head.get("Metadata", {}).get(CONTENT_HASH_METADATA) == self.content_hash \
+                    and head.get("ContentEncoding") == self.content_encoding:
+                return head["ETag"]
+
+        # A bucket that can't be checked is just uploaded to:
+        found, _ = _for_each_bucket(check, buckets, self.prefix)
+        unchanged = {bucket: etag for bucket, etag in found.items() if etag}
+        if unchanged:
+            log.debug("[/] The report in {} has not changed -- not uploading it.".format(", ".join(unchanged)))
+            self.skipped += list(unchanged)
+
+        return unchanged
+
+    def close(self):
+        if self._compressor:
+            self._buffer += self._compressor.flush()
+            self._compressor = None
+            self._send_full_parts()
+
+        unchanged = self._find_unchanged(self._targets) if self.content_hash else {}
+        if not self._uploader:
+            # Everything fit within a single part:
+            def upload(bucket):
+                log.debug("[-->] Dumping to {}/{}".format(bucket, self.prefix))
+                return _upload_to_s3(bytes(self._buffer), get_bucket_client(bucket), bucket, self.prefix,
+                                     content_type=self.content_type, content_encoding=self.content_encoding,
+                                     metadata=self._metadata)
+
+            self.etags, failures = _for_each_bucket(upload, [bucket for bucket in self._targets
+                                                             if bucket not in unchanged], self.prefix)
+            self._failures.update(failures)
+
+        else:
+            try:
+                self._complete_multipart(unchanged)
+
+            except Exception:
+                # The multipart uploads are not left behind if they could not be completed:
+                self.abort()
+                raise
+
+        self.etags.update(unchanged)
+
+        if CONFIG.replicate_with_copy and self.etags:
+            # If the source bucket did not change, then only the copies that differ from it are replaced:
+            replicas = self.buckets[1:]
+            if unchanged:
+                same = self._find_unchanged(replicas)
+                self.etags.update(same)
+                replicas = [bucket for bucket in replicas if bucket not in same]
+
+            copied, failures = _replicate(self._targets[0], replicas, self.prefix)
+            self.etags.update(copied)
+            self._failures.update(failures)
+
+        if self._failures:
+            raise ReportUploadError(self._failures)
+
+        log.debug("[+] Completed dumping to all buckets.")
+
+    def _complete_multipart(self, unchanged):
+        """Completes the multipart uploads to the buckets that changed, and aborts those to the `unchanged` buckets."""
+        if self._buffer:
+            self._submit(bytes(self._buffer))
+            self._buffer = bytearray()
+
+        self._stop_uploader()
+        if self._error:
+            raise self._error
+
+        for bucket in unchanged:
+            upload_id = self._upload_ids.pop(bucket, None)
+            if upload_id:
+                get_bucket_client(bucket).abort_multipart_upload(Bucket=bucket, Key=self.prefix,
+                                                                 UploadId=upload_id)
+
+        def complete(bucket):
+            client = get_bucket_client(bucket)
+            etag = client.complete_multipart_upload(
+                Bucket=bucket, Key=self.prefix, UploadId=self._upload_ids[bucket],
+                MultipartUpload={"Parts": self._completed_parts[bucket]})["ETag"]
+            log.debug("[+] Completed multipart upload to {}/{}".format(bucket, self.prefix))
+
+            if self.content_hash:
+                etag = _replace_metadata_in_s3(client, bucket, self.prefix, content_type=self.content_type,
+                                               content_encoding=self.content_encoding, metadata=self._metadata)
+
+            return etag
+
+        self.etags, failures = _for_each_bucket(complete, list(self._upload_ids), self.prefix)
+        self._fail(failures)
+        self._upload_ids = {}
+
+    def _abort_upload(self, bucket, upload_id):
+        log.error("[X] Aborting the multipart upload to {}/{}".format(bucket, self.prefix))
+        try:
+            get_bucket_client(bucket).abort_multipart_upload(Bucket=bucket, Key=self.prefix, UploadId=upload_id)
+        except (BotoCoreError, ClientError) as e:
+            log.error("[X] Unable to abort the multipart upload to {}/{}: {}".format(bucket, self.prefix, e))
+
+    def abort(self):
+        self._stop_uploader()
+        for bucket, upload_id in self._upload_ids.items():
+            self._abort_upload(bucket, upload_id)
+
+        self._upload_ids = {}
+
+
+def fetch_from_s3(etag=None, prefix=None):
     """
     This will fetch the report object from S3.
-    :param bucket:
-    :param prefix:
-    :return:
+    :param etag: If supplied, the report is only downloaded if it no longer matches this ETag. Otherwise, `NOT_MODIFIED`
+                 is returned in place of the report.
+    :param prefix: Defaults to `CONFIG.import_prefix`.
+    :return: A tuple of the report (or None if it does not exist) and its ETag.
+    """
+    return _get_from_s3(get_bucket_client(CONFIG.import_bucket), CONFIG.import_bucket, prefix or CONFIG.import_prefix,
+                        etag=etag)
+
+
+def open_report_stream(prefix=None):
     """
-    client = boto3.client("s3")
-    return _get_from_s3(client, CONFIG.import_bucket, CONFIG.import_prefix)
+    Opens the report object in S3 for reading -- without downloading all of it up front.
+    :param prefix: Defaults to `CONFIG.import_prefix`.
+    :return: A binary, file-like object of the (decompressed) report, or None if it does not exist.
+    """
+    try:
+        response = get_bucket_client(CONFIG.import_bucket).get_object(Bucket=CONFIG.import_bucket,
+                                                                      Key=prefix or CONFIG.import_prefix)
+
+    except ClientError as ce:
+        if ce.response['Error']['Code'] == 'NoSuchKey':
+            return None
+
+        raise
+
+    return open_decompressed(response["Body"], response.get("ContentEncoding"))
+
+
+def fetch_bucket_entry(name, offsets, prefix=None):
+    """
+    Fetches a single bucket's entry out of the report with a `Range` GET -- instead of downloading the whole report.
+    :param name: The name of the bucket.
+    :param offsets: The offset index of the report (see `historical_reports.s3.indexes`).
+    :param prefix: Defaults to `CONFIG.import_prefix`.
+    :return: The bucket's details, or None if the bucket is not in the report. If the report has changed since the
+             offset index was made, then a `ClientError` (PreconditionFailed) is raised.
+    """
+    location = offsets["buckets"].get(name)
+    if not location:
+        return None
+
+    entry = _get_range_from_s3(get_bucket_client(CONFIG.import_bucket), CONFIG.import_bucket,
+                               prefix or CONFIG.import_prefix, *location,
+                               etag=offsets.get("etags", {}).get(CONFIG.import_bucket))
+
+    # The entry is a `"name": {...}` member of the report's buckets:
+    return loads(b"{" + entry + b"}")[name]
 
 
 def set_config_from_input(lambda_input):
@@ -51,7 +51,10 @@ setup(
     zip_safe=False,
     install_requires=install_requires,
     extras_require={
-        'tests': tests_require
+        'tests': tests_require,
+        'fast_json': ['orjson'],
+        'zstd': ['zstandard'],
+        'streaming': ['ijson>=3.1']
     },
     entry_points={
         'console_scripts': [